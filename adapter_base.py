@@ -1,8 +1,12 @@
 import logging
 from abc import ABC, abstractmethod
+from datetime import date
 
 from seleniumrequests import Firefox
 
+from event_matching import AUTO_MATCH_SCORE, EventIndex
+from state_store import StateStore, payload_hash
+
 
 def login_required(func):
     def inner(*args, **kwargs):
@@ -14,10 +18,19 @@ def login_required(func):
 
 
 class AdapterBase(ABC):
-    def __init__(self, driver: Firefox, name: str):
+    def __init__(self, driver: Firefox, name: str, state: StateStore | None = None):
+        """
+        :param driver: Browser to automate the platform with
+        :param name: Platform name, for printing and in the state store
+        :param state: Store to remember published events between runs, None to not remember
+        """
         self.driver = driver
         self.__name = name
+        self.state = state
         self.logged_in = False
+        self._match_index = None
+        # Listing of `get_events`, kept until this adapter writes
+        self._events_cache = None
 
     @abstractmethod
     def login(self):
@@ -27,6 +40,12 @@ class AdapterBase(ABC):
     def get_events(self):
         pass
 
+    def clear_events_cache(self):
+        """
+        Forget the kept listing, for when the platform was changed by another adapter (see `driver_pool`).
+        """
+        self._events_cache = None
+
     @abstractmethod
     @login_required
     def create_event(self, event: dict):
@@ -37,6 +56,26 @@ class AdapterBase(ABC):
     def update_event(self, event: dict, existing_event: dict):
         pass
 
+    def _platform_event_date(self, platform_event: dict) -> date | None:
+        """
+        Start date of a platform event, used for matching. Override when the platform listing has one.
+
+        :param platform_event: Event from `get_events`
+        :return: Start date, None if unknown
+        """
+        return None
+
+    def _get_match_index(self, platform_events: list[dict]) -> EventIndex:
+        """
+        Get the matching index of a platform listing, built once per listing.
+
+        :param platform_events: Events from `get_events`
+        :return: Index
+        """
+        if self._match_index is None or self._match_index.platform_events is not platform_events:
+            self._match_index = EventIndex(platform_events, date_key=self._platform_event_date)
+        return self._match_index
+
     def _select_event(self, platform_events: list[dict], event: dict) -> dict | None:
         """
         Automatically or manually selects a platform event from a list.
@@ -52,29 +91,28 @@ class AdapterBase(ABC):
         if auto_choice is not None:
             return auto_choice
 
-        return self._select_event_manual(platform_events)
+        # Show the most similar events first
+        ranked = [platform_event for platform_event, _ in self._get_match_index(platform_events).ranked(event)]
+        ranked_ids = {id(platform_event) for platform_event in ranked}
+        ranked += [platform_event for platform_event in platform_events if id(platform_event) not in ranked_ids]
+        return self._select_event_manual(ranked)
 
     def _select_event_auto(self, platform_events: list[dict], event: dict, log=True) -> dict | None:
         """
-        Automatically or select a platform event from a list.
+        Automatically select a platform event from a list, if one matches well enough.
 
         :param platform_events: Events to choose from
-        :param event: Source info to look for (mainly name)
+        :param event: Source info to look for (mainly name and start)
         :return: Selected event
         """
         if not platform_events:
             return None
 
-        auto_choice = None
-        for i, facebook_event in enumerate(platform_events):
-            if event['name'] in facebook_event['name']:
-                auto_choice = i
-                break
-
-        if auto_choice is not None:
+        match, score = self._get_match_index(platform_events).best_match(event)
+        if match is not None and score >= AUTO_MATCH_SCORE:
             if log:
-                print(f"{self.__name}: Found event automatically!")
-            return platform_events[auto_choice]
+                print(f"{self.__name}: Found event automatically! (score {score:.2f})")
+            return match
 
         return None
 
@@ -100,18 +138,148 @@ class AdapterBase(ABC):
 
         return None
 
+    def platform_payload(self, event: dict) -> dict:
+        """
+        The event information that ends up on the platform, used to detect changes since the last publish.
+
+        :param event: Event information
+        :return: Published information
+        """
+        image_path = event.get('image_path')
+        return {
+            'name': event['name'],
+            'description': event['content-unicode'],
+            'start': event['start'].isoformat(),
+            'end': event['end'].isoformat(),
+            'venue': event['venue'],
+            'address': event['address'],
+            # Images are stored content-addressed, so the name changes with the content
+            'image': image_path.name if image_path else None,
+        }
+
+    def _event_from_id(self, platform_id: str) -> dict | None:
+        """
+        Platform event to update, from the id remembered in the state store. Override when the platform supports it.
+
+        :param platform_id: Id (or link) of the event on the platform
+        :return: Event that can be passed to `update_event`, None if not supported
+        """
+        return None
+
+    def _published_id(self, existing_event: dict | None, result) -> str | None:
+        """
+        Id of the event on the platform after creating/updating it, to remember in the state store.
+
+        :param existing_event: Event that was updated, None if created
+        :param result: Result of `create_event`/`update_event`
+        :return: Platform id, None if unknown
+        """
+        return None
+
+    def _known_publication(self, event: dict) -> dict | None:
+        if self.state is None:
+            return None
+        return self.state.get(event['slug'], self.__name.lower())
+
+    def is_published(self, event: dict) -> bool:
+        """
+        Whether the event was published before exactly as it is now, according to the state store.
+
+        :param event: Event information
+        :return: If unchanged since the last publish
+        """
+        known = self._known_publication(event)
+        return known is not None and known['payload_hash'] == payload_hash(self.platform_payload(event))
+
+    def _publish(self, event: dict, existing_event: dict | None):
+        """
+        Create or update the event, and remember it in the state store.
+
+        :param event: Event information
+        :param existing_event: Platform event to update, None to create
+        :return: Result of the creation/update
+        """
+        if existing_event:
+            result = self.update_event(event, existing_event)
+        else:
+            result = self.create_event(event)
+        if self.state is not None and result:
+            self.state.record(event['slug'], self.__name.lower(), "", self._published_id(existing_event, result),
+                              payload_hash(self.platform_payload(event)))
+        return result
+
     def do_event(self, event: dict) -> bool:
         """
         Make sure a given event is present (created/updated) on the platform.
+        Events that did not change since they were last published are skipped, and a remembered platform id is used
+        instead of listing the platform.
 
         :param event: Event information
         :return: New/updated event
         """
         try:
-            platform_events = self.get_events()
-            existing_event = self._select_event(platform_events, event)
-            if existing_event:
-                return self.update_event(event, existing_event)
-            return self.create_event(event)
+            if self.is_published(event):
+                print(f"{self.__name}: {event['name']} unchanged since it was last published, skipping")
+                return True
+            known = self._known_publication(event)
+            existing_event = self._event_from_id(known['platform_id']) if known and known['platform_id'] else None
+            if existing_event is None:
+                platform_events = self.get_events()
+                existing_event = self._select_event(platform_events, event)
+            return self._publish(event, existing_event)
         except BaseException:
             logging.exception(f"Something went wrong processing {event['name']}")
+
+    def match_events(self, events: list[dict]) -> list[tuple[bool, dict | None]]:
+        """
+        Find the platform event of every event, listing the platform at most once.
+        Unchanged and remembered events are handled as in `do_event`.
+
+        :param events: Event information of every event
+        :return: Per event, whether it needs to be published, and the platform event to update (None to create)
+        """
+        matches = []
+        to_match = []
+        for i, event in enumerate(events):
+            if self.is_published(event):
+                print(f"{self.__name}: {event['name']} unchanged since it was last published, skipping")
+                matches.append((False, None))
+                continue
+            known = self._known_publication(event)
+            existing_event = self._event_from_id(known['platform_id']) if known and known['platform_id'] else None
+            if existing_event is None:
+                to_match.append(i)
+            matches.append((True, existing_event))
+
+        if to_match:
+            platform_events = self.get_events()
+            for i in to_match:
+                matches[i] = (True, self._select_event(platform_events, events[i]))
+        return matches
+
+    def do_events(self, events: list[dict]) -> list[tuple[dict, object]]:
+        """
+        Make sure the given events are present (created/updated) on the platform.
+        The platform is listed once, all events are matched against that listing, and then created or updated.
+
+        :param events: Event information of every event
+        :return: Per event, the event and the result of its creation/update (None if it failed)
+        """
+        try:
+            matches = self.match_events(events)
+        except Exception:
+            logging.exception(f"{self.__name}: Something went wrong listing the events")
+            return [(event, None) for event in events]
+
+        results = []
+        for event, (needs_publish, existing_event) in zip(events, matches):
+            if not needs_publish:
+                results.append((event, True))
+                continue
+            try:
+                result = self._publish(event, existing_event)
+            except Exception:
+                logging.exception(f"Something went wrong processing {event['name']}")
+                result = None
+            results.append((event, result))
+        return results
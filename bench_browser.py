@@ -0,0 +1,115 @@
+"""
+Benchmark of the browser modes of `main.create_driver`: the default windowed browser against the headless,
+resource-blocking performance mode.
+
+    python bench_browser.py [url ...] [--form]
+
+For every mode and URL, the time until `driver.get` returns and the navigation timings of the page are printed.
+With --form, the Facebook event form is also filled in per mode, timed per step (see `FacebookAdapter.step_timings`).
+The form is never submitted, so nothing is published. This logs in to Facebook with the credentials of `get_config`.
+A separate copy of the Firefox profile is used per mode, so the real profile is not touched and both start with the
+same cache.
+"""
+import argparse
+import shutil
+import time
+from datetime import datetime, timedelta
+
+from driver_pool import profile_lock_files
+from main import create_driver, create_fb_adapter, get_config
+from utils import DEFAULT_TZ, runtime_data_folder
+
+default_urls = [
+    "https://dsda.nl/events/",
+    "https://www.facebook.com/events/create/",
+    "https://app.uni-life.nl/login",
+]
+
+navigation_timing_script = """
+const timing = performance.getEntriesByType('navigation')[0];
+return timing ? [timing.domContentLoadedEventEnd, timing.loadEventEnd, timing.transferSize] : null;
+"""
+
+create_url = "https://www.facebook.com/events/create/"
+
+
+def form_event() -> dict:
+    """
+    Event to fill in the form with, a month from now. It is never submitted.
+    """
+    start = DEFAULT_TZ.localize(datetime.now().replace(hour=20, minute=0, second=0, microsecond=0)
+                                + timedelta(days=30))
+    return {'name': "Benchmark event", 'content-unicode': "Form fill benchmark, not published.", 'start': start,
+            'end': start + timedelta(hours=3), 'venue': "Lindenhoff", 'address': "Lindenhoff 1, 2611 HA Delft",
+            'image_path': None}
+
+
+def benchmark_form(driver, config: dict, repeat: int) -> dict:
+    """
+    Fill in the Facebook event form without submitting it.
+
+    :return: Per step, the fastest time, and 'load' for loading the form page
+    """
+    adapter = create_fb_adapter(config, driver)
+    adapter.login()
+    event = form_event()
+    timings = {}
+    for _ in range(repeat):
+        adapter.step_timings = {}
+        start = time.perf_counter()
+        driver.get(create_url)
+        adapter.step_timings['load'] = time.perf_counter() - start
+        adapter._fil_event_info(event)
+        for step, duration in adapter.step_timings.items():
+            timings[step] = min(duration, timings.get(step, duration))
+    return timings
+
+
+def benchmark_mode(performance: bool, urls: list[str], repeat: int, config: dict | None = None) -> dict:
+    profile_dir = runtime_data_folder / f"firefox-profile-bench-{'performance' if performance else 'default'}"
+    shutil.rmtree(profile_dir, ignore_errors=True)
+    source_profile = runtime_data_folder / 'firefox-profile'
+    if source_profile.exists():
+        shutil.copytree(source_profile, profile_dir, ignore=shutil.ignore_patterns(*profile_lock_files))
+
+    start = time.perf_counter()
+    driver = create_driver(performance=performance, profile_dir=profile_dir)
+    results = {'startup': time.perf_counter() - start}
+    try:
+        for url in urls:
+            timings = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                driver.get(url)
+                get_time = time.perf_counter() - start
+                navigation = driver.execute_script(navigation_timing_script) or [0, 0, 0]
+                timings.append((get_time, *navigation))
+            # Fastest run by time until get returned
+            results[url] = min(timings)
+        if config is not None:
+            results['form'] = benchmark_form(driver, config, repeat)
+    finally:
+        driver.quit()
+        shutil.rmtree(profile_dir, ignore_errors=True)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark browser modes")
+    parser.add_argument("urls", nargs="*", default=default_urls, help="Pages to load")
+    parser.add_argument("--repeat", type=int, default=3, help="Loads per page, the fastest one counts")
+    parser.add_argument("--form", action="store_true", help="Also time filling in the Facebook event form")
+    args = parser.parse_args()
+    config = get_config() if args.form else None
+
+    for performance in (False, True):
+        results = benchmark_mode(performance, args.urls, args.repeat, config)
+        print(f"\n{'Performance' if performance else 'Default'} mode, browser startup {results['startup']:.2f} s")
+        print(f"{'url':45} {'get (s)':>8} {'DOM ready (ms)':>15} {'load (ms)':>10} {'transfer (kB)':>14}")
+        for url in args.urls:
+            get_time, dom_ready, load, transfer = results[url]
+            print(f"{url[:45]:45} {get_time:8.2f} {dom_ready:15.0f} {load:10.0f} {transfer / 1024:14.0f}")
+        if 'form' in results:
+            print("Facebook form, fastest per step: "
+                  + ", ".join(f"{step} {duration:.2f} s" for step, duration in results['form'].items())
+                  + f", total {sum(results['form'].values()):.2f} s")
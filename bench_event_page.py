@@ -0,0 +1,110 @@
+"""
+Benchmark of the event page extraction: the targeted parse of `event_page` against a full `html.parser` soup with
+separate lookups, as `get_event_info` used to do.
+
+Run with saved event pages:
+    python bench_event_page.py --save      # Download the current event pages as fixtures
+    python bench_event_page.py [folder]    # Time both extractions on the saved pages
+"""
+import argparse
+import timeit
+from pathlib import Path
+
+from bs4 import BeautifulSoup
+
+from event_page import PARSER, parse_event_page
+from utils import runtime_data_folder
+
+default_fixture_folder = runtime_data_folder / "page_fixtures"
+
+
+def parse_event_page_full(page_html: str) -> dict:
+    """
+    Extraction as done before, with a full tree of the page.
+
+    :param page_html: HTML of the event page
+    :return: Event details
+    """
+    soup = BeautifulSoup(page_html, 'html.parser')
+
+    details = {}
+    details['start_date'] = soup.find("abbr", "tribe-events-start-date")['title']
+    details['end_date'] = soup.find("div", "tribe-events-start-time")['title']
+    times = soup.find("div", "tribe-events-start-time").text.strip().split(' - ')
+    details['start_time'] = times[0]
+    details['end_time'] = times[1]
+
+    try:
+        details['venue'] = soup.find("li", "tribe-venue").text.strip()
+    except AttributeError:
+        details['venue'] = ''
+
+    if soup.find("span", "tribe-street-address") is not None:
+        address = soup.find("span", "tribe-street-address").text.strip()
+        try:
+            postal_code = soup.find("span", "tribe-postal-code").text.strip()
+        except AttributeError:
+            postal_code = ''
+        try:
+            locality = soup.find("span", "tribe-locality").text.strip()
+        except AttributeError:
+            locality = ''
+        details['address'] = f'{address}, {postal_code} {locality}'
+    else:
+        details['address'] = ''
+
+    try:
+        categories_wrapper = soup.find("span", "tribe-events-event-categories")
+        details['categories'] = [cat.text for cat in categories_wrapper.find_all('a')]
+    except AttributeError:
+        details['categories'] = []
+
+    image_tag = soup.find("img", "wp-post-image")
+    details['image_url'] = image_tag['src'] if image_tag is not None else None
+    return details
+
+
+def save_fixtures(folder: Path):
+    from main import iter_events
+    import http_client
+
+    folder.mkdir(parents=True, exist_ok=True)
+    for event in iter_events():
+        page = http_client.get(event['link'])
+        with open(folder / f"{event['slug']}.html", "w", encoding="utf-8") as f:
+            f.write(page.text)
+        print(f"Saved {event['slug']}")
+
+
+def benchmark(folder: Path, repeat: int):
+    pages = sorted(folder.glob("*.html"))
+    if not pages:
+        print(f"No fixture pages in {folder}, save them first with --save")
+        return
+
+    print(f"Targeted parse uses the {PARSER} parser\n")
+    print(f"{'page':40} {'full (ms)':>10} {'targeted (ms)':>14} {'speed-up':>9}")
+    total_full = total_targeted = 0
+    for path in pages:
+        page_html = path.read_text(encoding="utf-8")
+        assert parse_event_page(page_html) == parse_event_page_full(page_html), f"Different result for {path.name}"
+        full = min(timeit.repeat(lambda: parse_event_page_full(page_html), number=1, repeat=repeat)) * 1000
+        targeted = min(timeit.repeat(lambda: parse_event_page(page_html), number=1, repeat=repeat)) * 1000
+        total_full += full
+        total_targeted += targeted
+        print(f"{path.stem[:40]:40} {full:10.2f} {targeted:14.2f} {full / targeted:8.1f}x")
+    print(f"{'mean':40} {total_full / len(pages):10.2f} {total_targeted / len(pages):14.2f} "
+          f"{total_full / total_targeted:8.1f}x")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark event page extraction")
+    parser.add_argument("folder", nargs="?", type=Path, default=default_fixture_folder,
+                        help="Folder with saved event pages (.html)")
+    parser.add_argument("--save", action="store_true", help="Download the current event pages into the folder")
+    parser.add_argument("--repeat", type=int, default=10, help="Runs per page, the fastest one counts")
+    args = parser.parse_args()
+
+    if args.save:
+        save_fixtures(args.folder)
+    benchmark(args.folder, args.repeat)
@@ -1,19 +1,34 @@
 import datetime
+import logging
 import os.path
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
+from google_auth_httplib2 import AuthorizedHttp
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 from googleapiclient.discovery import Resource
+from googleapiclient.http import HttpRequest
 import base32hex
+import httplib2
 
-from utils import DEFAULT_TZ, DEFAULT_TZ_STR
+from calendar_index import CalendarIndex, parse_event_time
+from event_matching import AUTO_MATCH_SCORE, EventIndex
+from state_store import StateStore, payload_hash
+from utils import DEFAULT_TZ, DEFAULT_TZ_STR, runtime_data_folder
 
 # If modifying these scopes, delete the file token.json.
 SCOPES = ['https://www.googleapis.com/auth/calendar']
 
+calendar_index_folder = runtime_data_folder / "calendar_index"
+
+# Only one thread at a time can ask the user to pick an event
+_prompt_lock = threading.Lock()
+
 
 calendar_ids = {
     'testing': 'primary',
@@ -26,8 +41,122 @@ calendar_ids = {
 
 
 class CalendarAdapter:
-    def __init__(self):
-        self.service = get_service()
+    # Refresh the access token this long before it expires
+    refresh_margin = datetime.timedelta(minutes=5)
+    # Maximum number of requests in one batch request, as recommended by Google
+    batch_size = 50
+
+    def __init__(self, batched: bool = True, max_workers: int = 6, state: StateStore | None = None):
+        """
+        Authorization and building the service happen on first use, see `warm_start.WarmStart` to start them in the
+        background.
+
+        :param batched: Send the writes for all calendars of an event together, in batch requests
+        :param max_workers: Maximum number of concurrent requests in `do_events_parallel`
+        :param state: Store to remember the Calendar event ids between runs, None to not remember
+        """
+        self.state = state
+        self._credentials = None
+        self._service = None
+        self._service_lock = threading.Lock()
+        self._refresh_timer = None
+        self.batched = batched
+        self.max_workers = max_workers
+        self._indexes = {}
+        self._indexes_lock = threading.Lock()
+        self._thread_local = threading.local()
+        self.stats = Counter()  # Number of created, patched and skipped (unchanged) events
+        self._stats_lock = threading.Lock()
+
+    @property
+    def credentials(self) -> Credentials:
+        with self._service_lock:
+            if self._credentials is None:
+                self._credentials = get_credentials()
+                self._schedule_refresh()
+            return self._credentials
+
+    @property
+    def service(self) -> Resource:
+        credentials = self.credentials
+        with self._service_lock:
+            if self._service is None:
+                self._service = get_service(credentials)
+            return self._service
+
+    def _schedule_refresh(self):
+        """
+        Refresh the credentials in the background shortly before they expire, so no request has to wait for it.
+        """
+        if self._credentials.expiry is None or not self._credentials.refresh_token:
+            return
+        # Expiry is naive UTC
+        delay = self._credentials.expiry - datetime.datetime.utcnow() - self.refresh_margin
+        self._refresh_timer = threading.Timer(max(delay.total_seconds(), 0), self._refresh_credentials)
+        self._refresh_timer.daemon = True
+        self._refresh_timer.start()
+
+    def _refresh_credentials(self):
+        try:
+            self._credentials.refresh(Request())
+            save_credentials(self._credentials)
+        except Exception as error:
+            print(f"Calendar: Could not refresh credentials in the background: {error!r}")
+            return
+        self._schedule_refresh()
+
+    def _http(self) -> AuthorizedHttp:
+        """
+        Get the HTTP transport of the current thread. httplib2 is not thread-safe, so every thread gets its own,
+        sharing the credentials.
+
+        :return: Authorized HTTP transport
+        """
+        if not hasattr(self._thread_local, 'http'):
+            self._thread_local.http = AuthorizedHttp(self.credentials, http=httplib2.Http())
+        return self._thread_local.http
+
+    def _execute(self, request: HttpRequest) -> dict:
+        return request.execute(http=self._http())
+
+    def _count(self, action: str):
+        with self._stats_lock:
+            self.stats[action] += 1
+
+    def _remember(self, event: dict, category: str, g_event: dict):
+        """
+        Remember in the state store which Calendar event an event is published as.
+
+        :param event: Source info
+        :param category: Calendar category
+        :param g_event: Calendar event
+        """
+        if self.state is not None:
+            self.state.record(event['slug'], "calendar", category, g_event['id'],
+                              payload_hash(self.g_event_from_event(event, category)))
+
+    def index(self, category: str) -> CalendarIndex:
+        """
+        Get the local index of a calendar, synced once per session on first use.
+
+        :param category: Calendar category
+        :return: Up-to-date index
+        """
+        with self._indexes_lock:
+            if category not in self._indexes:
+                index = CalendarIndex(calendar_index_folder / f"{category}.json")
+                changed = index.sync(self.service, calendar_ids[category], self._http())
+                print(f"Calendar: Synced {category} calendar, {changed} changed events")
+                self._indexes[category] = index
+            return self._indexes[category]
+
+    def refresh(self):
+        """
+        Get the changes of all calendars that are in use since they were last synced.
+        """
+        for category, index in self._indexes.items():
+            changed = index.sync(self.service, calendar_ids[category], self._http())
+            print(f"Calendar: Synced {category} calendar, {changed} changed events")
 
     @staticmethod
     def event_id(event: dict) -> str:
@@ -63,12 +192,13 @@ class CalendarAdapter:
         }
         return event
 
-    def do_event(self, event: dict) -> list[dict]:
+    @staticmethod
+    def event_categories(event: dict) -> list[str]:
         """
-        Make sure a given event is present (created/updated) for all relevant event categories.
+        Get the calendar categories an event should be published in.
 
         :param event: Event information
-        :return: Calendar events
+        :return: Categories that have a calendar
         """
         event_categories = list(event['categories'])  # Categories from website
         categories = ['general'] + event_categories  # Categories to publish on
@@ -79,11 +209,46 @@ class CalendarAdapter:
         if has_dance_category:
             categories.append('danszusjes')
 
+        return [category for category in categories if calendar_ids.get(category) is not None]
+
+    @staticmethod
+    def changed_fields(g_event_data: dict, g_event: dict) -> dict:
+        """
+        Get the fields of the desired Calendar event that differ from an existing Calendar event.
+
+        :param g_event_data: Desired event, see `g_event_from_event`
+        :param g_event: Existing Calendar event
+        :return: Changed fields with their desired value, empty if nothing changed
+        """
+        changes = {}
+        for field in ('summary', 'location', 'description'):
+            if g_event_data[field] != g_event.get(field, ''):
+                changes[field] = g_event_data[field]
+        for field in ('start', 'end'):
+            # Compare the moments, Google returns them in its own format
+            if g_event.get(field) is None or \
+                    parse_event_time(g_event_data[field]) != parse_event_time(g_event[field]):
+                changes[field] = g_event_data[field]
+        return changes
+
+    def print_stats(self):
+        print(f"Calendar: {self.stats['created']} created, {self.stats['patched']} patched, "
+              f"{self.stats['skipped']} unchanged")
+
+    def do_event(self, event: dict) -> list[dict]:
+        """
+        Make sure a given event is present (created/updated) for all relevant event categories.
+
+        :param event: Event information
+        :return: Calendar events
+        """
+        if self.batched:
+            return self.do_events([event])[0]
+
+        categories = self.event_categories(event)
         g_events = []
 
         for category in categories:
-            if calendar_ids.get(category) is None:
-                continue
             g_event = self.find_event(event, category)
             if g_event is None:
                 g_event = self.create_event(event, category)
@@ -93,6 +258,101 @@ class CalendarAdapter:
 
         return g_events
 
+    def do_events_parallel(self, events: list[dict]) -> list[list[dict]]:
+        """
+        Make sure the given events are present in all their calendars, working on different events and categories
+        at the same time, with at most `max_workers` requests in flight.
+
+        :param events: Event information of every event
+        :return: Per event, the Calendar events
+        """
+        def do_category(event: dict, category: str) -> dict | None:
+            try:
+                g_event = self.find_event(event, category)
+                if g_event is None:
+                    return self.create_event(event, category)
+                return self.update_event(event, g_event, category)
+            except HttpError as error:
+                print(f"Calendar: An error occurred for {event['name']} in the {category} calendar: {error}")
+                return None
+            except Exception:
+                # One failing job should not stop the others, their writes are already being made
+                logging.exception(f"Calendar: Something went wrong for {event['name']} in the {category} calendar")
+                return None
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = [[executor.submit(do_category, event, category) for category in self.event_categories(event)]
+                       for event in events]
+            return [[g_event for future in event_futures if (g_event := future.result()) is not None]
+                    for event_futures in futures]
+
+    def do_events(self, events: list[dict]) -> list[list[dict]]:
+        """
+        Make sure the given events are present in all their calendars.
+        All events are matched against the calendar indexes first, then all writes are sent in batch requests.
+
+        :param events: Event information of every event
+        :return: Per event, the Calendar events
+        """
+        # Per event and category to publish in: event number, category and existing Calendar event
+        jobs = []
+        for i, event in enumerate(events):
+            for category in self.event_categories(event):
+                jobs.append((i, category, self.find_event(event, category)))
+
+        written = {}
+
+        def on_write(request_id: str, response: dict, exception: HttpError | None):
+            i, category, g_event = jobs[int(request_id)]
+            if exception is not None:
+                print(f"Calendar: An error occurred writing {events[i]['name']} to the {category} calendar: "
+                      f"{exception}")
+                return
+            action = "patched" if g_event is not None else "created"
+            print(f"Calendar: Event {action} in {category} calendar: {response.get('htmlLink')}")
+            self._count(action)
+            self.index(category).upsert(response)
+            self._remember(events[i], category, response)
+            written[int(request_id)] = response
+
+        batch = self.service.new_batch_http_request(callback=on_write)
+        batch_count = 0
+        for j, (i, category, g_event) in enumerate(jobs):
+            if g_event is not None:
+                request = self._patch_request(events[i], g_event, category)
+                if request is None:
+                    print(f"Calendar: Event unchanged in {category} calendar")
+                    self._count('skipped')
+                    self._remember(events[i], category, g_event)
+                    written[j] = g_event
+                    continue
+            else:
+                request = self._insert_request(events[i], category)
+            batch.add(request, request_id=str(j))
+            batch_count += 1
+            if batch_count == self.batch_size:
+                batch.execute(http=self._http())
+                batch = self.service.new_batch_http_request(callback=on_write)
+                batch_count = 0
+        batch.execute(http=self._http())
+
+        for category in {category for _, category, _ in jobs}:
+            self.index(category).save()
+
+        return [[written[j] for j, (i, _, _) in enumerate(jobs) if i == event_number and j in written]
+                for event_number in range(len(events))]
+
+    def _insert_request(self, event: dict, category: str) -> HttpRequest:
+        g_event_data = self.g_event_from_event(event, category)
+        g_event_data['id'] = self.event_id(event)
+        return self.service.events().insert(calendarId=calendar_ids[category], body=g_event_data)
+
+    def _patch_request(self, event: dict, g_event: dict, category: str) -> HttpRequest | None:
+        changes = self.changed_fields(self.g_event_from_event(event, category), g_event)
+        if not changes:
+            return None
+        return self.service.events().patch(calendarId=calendar_ids[category], eventId=g_event['id'], body=changes)
+
     def create_event(self, event: dict, category: str = "general") -> dict:
         """
         Creates a Google Calendar event based on the info in `event`
@@ -101,29 +361,36 @@ class CalendarAdapter:
         :param category: Calendar category the event is for
         :return: Created Calendar event
         """
-        g_event_data = self.g_event_from_event(event, category)
-        g_event_data['id'] = self.event_id(event)
-
-        g_event = self.service.events().insert(calendarId=calendar_ids[category], body=g_event_data).execute()
+        g_event = self._execute(self._insert_request(event, category))
         print(f"Calendar: Event created in {category} calendar: {g_event.get('htmlLink')}")
+        self._count('created')
+        self._remember(event, category, g_event)
+        self.index(category).upsert(g_event)
+        self.index(category).save()
         return g_event
 
     def update_event(self, event: dict, g_event: dict, category: str = "general") -> dict:
         """
-        Updates the details of a given Google Calendar event to match the info in `event`
+        Updates the details of a given Google Calendar event to match the info in `event`.
+        Only the changed fields are sent, and nothing when the event is already up to date.
 
         :param event: Source info
         :param g_event: Calendar event to update
         :param category: Calendar category the event is from
         :return: Updated Calendar event
         """
-        g_event_data = self.g_event_from_event(event, category)
-        g_event_data['id'] = g_event['id']
-
-        g_event = self.service.events()\
-            .update(calendarId=calendar_ids[category], eventId=g_event['id'], body=g_event_data)\
-            .execute()
-        print(f"Calendar: Event updated in {category} calendar: {g_event.get('htmlLink')}")
+        request = self._patch_request(event, g_event, category)
+        if request is None:
+            print(f"Calendar: Event unchanged in {category} calendar")
+            self._count('skipped')
+            self._remember(event, category, g_event)
+            return g_event
+        g_event = self._execute(request)
+        print(f"Calendar: Event patched in {category} calendar: {g_event.get('htmlLink')}")
+        self._count('patched')
+        self._remember(event, category, g_event)
+        self.index(category).upsert(g_event)
+        self.index(category).save()
         return g_event
 
     @staticmethod
@@ -140,59 +407,60 @@ class CalendarAdapter:
             print("nothing")
             return None
 
-        auto_choice = None
-        for i, event_ob in enumerate(g_events):
-            if event['name'] in event_ob['summary']:
-                auto_choice = i
-                break
+        index = EventIndex(g_events, name_key='summary',
+                           date_key=lambda g_event: parse_event_time(g_event['start']).date())
+        ranked = index.ranked(event)
+        if ranked and ranked[0][1] >= AUTO_MATCH_SCORE:
+            print(f"found event automatically (score {ranked[0][1]:.2f})")
+            return ranked[0][0]
 
-        if auto_choice is not None:
-            print("found event automatically")
-            return g_events[auto_choice]
+        # Show the most similar events first
+        ranked_ids = {id(g_event) for g_event, _ in ranked}
+        g_events = [g_event for g_event, _ in ranked] + \
+            [g_event for g_event in g_events if id(g_event) not in ranked_ids]
 
-        print("\nCalendar: Select event to update:\n   0 for not included, create new one")
-        for i, event_ob in enumerate(g_events):
-            print(f"  {i + 1}: {event_ob['summary']}")
+        with _prompt_lock:
+            print(f"\nCalendar: Select event to update for {event['name']}:\n   0 for not included, create new one")
+            for i, event_ob in enumerate(g_events):
+                print(f"  {i + 1}: {event_ob['summary']}")
 
-        choice = int(input("Pick: "))
+            choice = int(input("Pick: "))
         if 0 < choice <= len(g_events):
             print(f"Calendar: Found event using {method}")
             return g_events[choice - 1]
 
     def find_event(self, event: dict, category: str = "general") -> dict | None:
         """
-        Search the calendar identified by `category` for a match of `event`.
+        Search the local index of the calendar identified by `category` for a match of `event`.
+        The id remembered in the state store and the deterministic id are tried first.
 
         :param event: Source event to find a match for
         :param category: Calendar to search in
         :return: Event, if found
         """
-        supposed_id = self.event_id(event)
-        try:
-            event_ob = self.service.events().get(calendarId=calendar_ids[category], eventId=supposed_id).execute()
+        index = self.index(category)
+        known = self.state.get(event['slug'], "calendar", category) if self.state is not None else None
+        if known is not None and known['platform_id'] is not None:
+            event_ob = index.get(known['platform_id'])
+            if event_ob is not None:
+                print("Calendar: Found event using remembered id")
+                return event_ob
+
+        event_ob = index.get(self.event_id(event))
+        if event_ob is not None:
             print("Calendar: Found event using id")
             return event_ob
-        except HttpError:
-            pass
 
         print('Calendar: Searching events based on event time... ', end='')
-        start_time = event['start'].isoformat()
-        end_time = event['end'].isoformat()
-        events_result = self.service.events().list(calendarId=calendar_ids[category], maxResults=15,
-                                                   timeMin=start_time, timeMax=end_time,
-                                                   singleEvents=True, orderBy='startTime').execute()
-        events = events_result.get('items', [])
+        events = index.in_window(event['start'], event['end'])
 
         chosen_event = self._select_event(events, event, "time")
         if chosen_event is not None:
             return chosen_event
 
         print('Calendar: Searching events based on search query... ')
-        now = datetime.datetime.utcnow().isoformat() + 'Z'
-        events_result = self.service.events().list(calendarId=calendar_ids[category], maxResults=15,
-                                                   timeMin=now, q=event['name'],
-                                                   singleEvents=True, orderBy='startTime').execute()
-        events = events_result.get('items', [])
+        now = datetime.datetime.now(datetime.timezone.utc)
+        events = index.search(event['name'], now)
 
         chosen_event = self._select_event(events, event, "search")
         if chosen_event is not None:
@@ -201,11 +469,16 @@ class CalendarAdapter:
         return None
 
 
-def get_service() -> Resource:
+def save_credentials(creds: Credentials):
+    with open('runtime_data/token.json', 'w') as token:
+        token.write(creds.to_json())
+
+
+def get_credentials() -> Credentials:
     """
-    Do authorization and get a resource object.
+    Do authorization.
 
-    :return: Calendar resource
+    :return: Valid credentials
     """
     creds = None
     # The file token.json stores the user's access and refresh tokens, and is
@@ -222,11 +495,24 @@ def get_service() -> Resource:
                 'google_api_credentials.json', SCOPES)
             creds = flow.run_local_server(port=0)
         # Save the credentials for the next run
-        with open('runtime_data/token.json', 'w') as token:
-            token.write(creds.to_json())
+        save_credentials(creds)
+
+    return creds
+
+
+def get_service(creds: Credentials | None = None) -> Resource:
+    """
+    Do authorization and get a resource object.
+    The discovery document shipped with the client library is used, so building needs no network.
+
+    :param creds: Credentials to use, authorizes when not given
+    :return: Calendar resource
+    """
+    if creds is None:
+        creds = get_credentials()
 
     try:
-        return build('calendar', 'v3', credentials=creds)
+        return build('calendar', 'v3', credentials=creds, static_discovery=True, cache_discovery=False)
 
     except HttpError as error:
         print(f'Calendar: An error occurred: {error}')
@@ -0,0 +1,141 @@
+import json
+import os
+import threading
+from datetime import datetime
+from pathlib import Path
+
+import httplib2
+from googleapiclient.discovery import Resource
+from googleapiclient.errors import HttpError
+
+from utils import DEFAULT_TZ, parse_datetime
+
+# Event fields kept in the index
+INDEX_FIELDS = ('id', 'summary', 'location', 'description', 'start', 'end', 'etag', 'htmlLink')
+
+
+def parse_event_time(event_time: dict) -> datetime:
+    """
+    Get the moment of a Calendar start/end field.
+
+    :param event_time: Field with either a `dateTime` or, for all-day events, a `date`
+    :return: Timezone aware datetime
+    """
+    if 'dateTime' in event_time:
+        return parse_datetime(event_time['dateTime'])
+    return DEFAULT_TZ.localize(datetime.fromisoformat(event_time['date']))
+
+
+class CalendarIndex:
+    """
+    Local copy of the events of one calendar, kept up to date with incremental sync (syncToken).
+    """
+
+    def __init__(self, path: Path):
+        """
+        :param path: File to persist the index in
+        """
+        self.path = path
+        self.sync_token = None
+        self.events = {}
+        self._lock = threading.Lock()
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            self.sync_token = data['sync_token']
+            self.events = data['events']
+        except (FileNotFoundError, ValueError, KeyError):
+            pass
+
+    def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # The whole write is under the lock, saves from several threads share the temporary file
+        with self._lock:
+            data = json.dumps({'sync_token': self.sync_token, 'events': self.events})
+            tmp_path = self.path.with_suffix(".tmp")
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write(data)
+            os.replace(tmp_path, self.path)
+
+    def sync(self, service: Resource, calendar_id: str, http: httplib2.Http | None = None) -> int:
+        """
+        Get the changes since the last sync, or all events when there was none.
+
+        :param service: Calendar resource
+        :param calendar_id: Calendar to sync
+        :param http: HTTP transport to use instead of the one of `service`, for use from other threads
+        :return: Number of changed events
+        """
+        changed = 0
+        page_token = None
+        while True:
+            try:
+                result = service.events().list(calendarId=calendar_id, maxResults=2500, syncToken=self.sync_token,
+                                               pageToken=page_token).execute(http=http)
+            except HttpError as error:
+                if error.resp.status == 410 and self.sync_token is not None:
+                    # Sync token expired, start over with a full sync
+                    with self._lock:
+                        self.sync_token = None
+                        self.events = {}
+                    return self.sync(service, calendar_id, http)
+                raise
+
+            for g_event in result.get('items', []):
+                self.upsert(g_event)
+                changed += 1
+
+            page_token = result.get('nextPageToken')
+            if page_token is None:
+                with self._lock:
+                    self.sync_token = result.get('nextSyncToken')
+                break
+
+        self.save()
+        return changed
+
+    def upsert(self, g_event: dict):
+        """
+        Put an event in the index, or remove it when it is cancelled (deleted).
+
+        :param g_event: Calendar event
+        """
+        with self._lock:
+            if g_event.get('status') == 'cancelled' or 'start' not in g_event or 'end' not in g_event:
+                self.events.pop(g_event['id'], None)
+            else:
+                self.events[g_event['id']] = {field: g_event[field] for field in INDEX_FIELDS if field in g_event}
+
+    def get(self, event_id: str) -> dict | None:
+        return self.events.get(event_id)
+
+    def in_window(self, start: datetime, end: datetime, max_results: int = 15) -> list[dict]:
+        """
+        Events overlapping with a time window, by start time.
+
+        :param start: Start of the window
+        :param end: End of the window
+        :param max_results: Maximum number of events returned
+        :return: Events
+        """
+        with self._lock:
+            events = [g_event for g_event in self.events.values()
+                      if parse_event_time(g_event['start']) < end and parse_event_time(g_event['end']) > start]
+        events.sort(key=lambda g_event: parse_event_time(g_event['start']))
+        return events[:max_results]
+
+    def search(self, text: str, after: datetime, max_results: int = 15) -> list[dict]:
+        """
+        Events after a given moment with `text` in the title, by start time.
+
+        :param text: Text to search for
+        :param after: Moment the events should end after
+        :param max_results: Maximum number of events returned
+        :return: Events
+        """
+        text = text.casefold()
+        with self._lock:
+            events = [g_event for g_event in self.events.values()
+                      if text in g_event.get('summary', '').casefold() and parse_event_time(g_event['end']) > after]
+        events.sort(key=lambda g_event: parse_event_time(g_event['start']))
+        return events[:max_results]
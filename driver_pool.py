@@ -0,0 +1,145 @@
+import logging
+import queue
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, Iterable
+
+from selenium.webdriver import Firefox
+
+from adapter_base import AdapterBase
+from utils import runtime_data_folder
+
+# Firefox refuses to open a profile that has these, and they belong to the browser using the original profile
+profile_lock_files = ("lock", ".parentlock", "parent.lock")
+# Databases a running browser may be writing to, a copy could be inconsistent. Not copied, so the pool browsers
+# start without cookies and log in with the saved session (see `FacebookAdapter.login`).
+profile_database_files = ("*.sqlite", "*.sqlite-wal", "*.sqlite-shm", "*.sqlite-journal", "sessionstore*")
+
+
+class DriverPool:
+    """
+    A number of isolated browsers, each with its own copy of the Firefox profile and its own adapter (and so its own
+    login state), to publish several events on a Selenium platform at the same time.
+    """
+
+    def __init__(self, size: int, create_driver: Callable[[Path], Firefox],
+                 create_adapter: Callable[[Firefox], AdapterBase],
+                 source_profile: Path = runtime_data_folder / 'firefox-profile'):
+        """
+        :param size: Number of browsers
+        :param create_driver: Starts a browser with the given profile folder, e.g. `main.create_driver`
+        :param create_adapter: Creates the platform adapter for a browser
+        :param source_profile: Profile copied for every browser, so they start with its settings and cache. May be
+                               in use by another browser.
+        """
+        self.size = size
+        self.create_driver = create_driver
+        self.create_adapter = create_adapter
+        self.source_profile = source_profile
+        self.drivers = []
+        self.adapters = []
+
+    def profile_dir(self, i: int) -> Path:
+        return self.source_profile.with_name(f"{self.source_profile.name}-pool-{i}")
+
+    def _start_browser(self, i: int) -> AdapterBase:
+        profile_dir = self.profile_dir(i)
+        shutil.rmtree(profile_dir, ignore_errors=True)
+        if self.source_profile.exists():
+            shutil.copytree(self.source_profile, profile_dir,
+                            ignore=shutil.ignore_patterns(*profile_lock_files, *profile_database_files))
+        driver = self.create_driver(profile_dir)
+        self.drivers.append(driver)
+        return self.create_adapter(driver)
+
+    def start(self):
+        """
+        Start the browsers, all at once since starting one takes a few seconds.
+        If one of them fails to start, the others are closed again.
+        """
+        if self.adapters:
+            return
+        try:
+            with ThreadPoolExecutor(max_workers=self.size) as executor:
+                self.adapters = list(executor.map(self._start_browser, range(self.size)))
+        except Exception:
+            self.close()
+            raise
+
+    def close(self):
+        for driver in self.drivers:
+            try:
+                driver.quit()
+            except Exception:
+                logging.exception("Could not close a browser of the pool")
+        self.drivers = []
+        self.adapters = []
+        for i in range(self.size):
+            shutil.rmtree(self.profile_dir(i), ignore_errors=True)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def map(self, work: Callable[[AdapterBase, object], object], items: Iterable) -> list:
+        """
+        Do work for every item, spread over the browsers. Every browser has a worker thread taking items from a
+        bounded queue, so a browser picks up the next item as soon as it is done with the previous one.
+
+        :param work: Function doing the work for one item with the adapter of a browser
+        :param items: Items to do the work for
+        :return: Per item, in the original order, the result of `work` (None if it raised)
+        """
+        self.start()
+        jobs = queue.Queue(maxsize=2 * self.size)
+        results = {}
+
+        def worker(adapter: AdapterBase):
+            while True:
+                job = jobs.get()
+                if job is None:
+                    return
+                i, item = job
+                try:
+                    results[i] = work(adapter, item)
+                except Exception:
+                    logging.exception(f"Something went wrong in browser {self.adapters.index(adapter) + 1}")
+                    results[i] = None
+
+        workers = [threading.Thread(target=worker, args=(adapter,), daemon=True) for adapter in self.adapters]
+        for thread in workers:
+            thread.start()
+        count = 0
+        for count, item in enumerate(items, start=1):
+            jobs.put((count - 1, item))  # Blocks while all browsers are busy and the queue is full
+        for _ in workers:
+            jobs.put(None)
+        for thread in workers:
+            thread.join()
+        return [results[i] for i in range(count)]
+
+    def publish(self, events: list[dict]) -> list[tuple[dict, object]]:
+        """
+        Make sure the given events are present on the platform, like `AdapterBase.do_events`, with the creates and
+        updates spread over the browsers. Matching is done once, with the listing of the first adapter.
+
+        :param events: Event information of every event
+        :return: Per event, the event and the result of its creation/update (None if it failed)
+        """
+        self.start()
+        try:
+            matches = self.adapters[0].match_events(events)
+        except Exception:
+            logging.exception("Something went wrong listing the events")
+            return [(event, None) for event in events]
+
+        to_publish = [(event, existing_event) for event, (needs_publish, existing_event) in zip(events, matches)
+                      if needs_publish]
+        published = iter(self.map(lambda adapter, job: adapter._publish(*job), to_publish))
+        return [(event, next(published) if needs_publish else True)
+                for event, (needs_publish, _) in zip(events, matches)]
@@ -0,0 +1,105 @@
+import re
+import unicodedata
+from datetime import date
+from typing import Callable
+
+# Minimal score to pick a platform event without asking
+AUTO_MATCH_SCORE = 0.7
+# Highest score of an event on another date, so another instance of a recurring event is never picked without asking
+DATE_MISMATCH_SCORE = 0.6
+
+_whitespace = re.compile(r"\s+")
+
+
+def normalize_name(name: str) -> str:
+    """
+    Normalize an event name for matching: case, accents, punctuation, emoji and whitespace are ignored,
+    as is the "BSS " prefix used in shared calendars.
+
+    :param name: Event name
+    :return: Normalized name
+    """
+    characters = []
+    for character in unicodedata.normalize("NFKD", name).casefold():
+        category = unicodedata.category(character)
+        if category[0] in "PZ":  # Punctuation and separators
+            characters.append(" ")
+        elif category[0] in "SCM":  # Symbols (emoji), control/format characters, accents
+            continue
+        else:
+            characters.append(character)
+    normalized = _whitespace.sub(" ", "".join(characters)).strip()
+    return normalized.removeprefix("bss ")
+
+
+class EventIndex:
+    """
+    Index of the events listed on a platform, to find the best match of a website event without scanning them all.
+    """
+
+    def __init__(self, platform_events: list[dict], name_key: str = 'name',
+                 date_key: Callable[[dict], date | None] = lambda platform_event: None):
+        """
+        :param platform_events: Events listed on the platform
+        :param name_key: Key of the event name in the platform events
+        :param date_key: Function giving the start date of a platform event, None when unknown
+        """
+        self.platform_events = platform_events
+        self.names = [normalize_name(platform_event.get(name_key, '')) for platform_event in platform_events]
+        self.tokens = [set(name.split()) for name in self.names]
+        self.dates = [date_key(platform_event) for platform_event in platform_events]
+
+        self.by_name = {}
+        self.postings = {}
+        self.by_date = {}
+        for i, (name, tokens, start_date) in enumerate(zip(self.names, self.tokens, self.dates)):
+            self.by_name.setdefault(name, []).append(i)
+            for token in tokens:
+                self.postings.setdefault(token, set()).add(i)
+            if start_date is not None:
+                self.by_date.setdefault(start_date, set()).add(i)
+
+    def _score(self, i: int, name: str, tokens: set, start_date: date | None) -> float:
+        if name == self.names[i]:
+            name_score = 1.0
+        elif name and self.names[i] and (name in self.names[i] or self.names[i] in name):
+            name_score = 0.9
+        else:
+            name_score = len(tokens & self.tokens[i]) / len(tokens | self.tokens[i]) if tokens else 0.0
+        date_score = 1.0 if start_date is not None and start_date == self.dates[i] else 0.0
+        score = 0.8 * name_score + 0.2 * date_score
+        if start_date is not None and self.dates[i] is not None and start_date != self.dates[i]:
+            return min(score, DATE_MISMATCH_SCORE)
+        return score
+
+    def ranked(self, event: dict) -> list[tuple[dict, float]]:
+        """
+        Score the platform events that share a word or the start date with `event`.
+
+        :param event: Website event
+        :return: Candidates with their score between 0 and 1, best first
+        """
+        name = normalize_name(event['name'])
+        tokens = set(name.split())
+        start_date = event['start'].date() if event.get('start') is not None else None
+
+        candidates = set(self.by_name.get(name, []))
+        for token in tokens:
+            candidates |= self.postings.get(token, set())
+        candidates |= self.by_date.get(start_date, set())
+
+        scored = [(i, self._score(i, name, tokens, start_date)) for i in candidates]
+        scored.sort(key=lambda item: (-item[1], item[0]))
+        return [(self.platform_events[i], score) for i, score in scored]
+
+    def best_match(self, event: dict) -> tuple[dict | None, float]:
+        """
+        Find the platform event that best matches `event`.
+
+        :param event: Website event
+        :return: Best candidate and its score, (None, 0) if nothing is similar
+        """
+        ranked = self.ranked(event)
+        if not ranked:
+            return None, 0.0
+        return ranked[0]
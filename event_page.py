@@ -0,0 +1,75 @@
+import re
+
+from bs4 import BeautifulSoup, SoupStrainer
+
+try:
+    import lxml  # noqa: F401
+    PARSER = 'lxml'
+except ImportError:
+    PARSER = 'html.parser'
+
+# Selector plan: what to find on an event page, as (tag, class). Every element is looked up once per page.
+SELECTORS = {
+    'start_date': ("abbr", "tribe-events-start-date"),
+    'start_time': ("div", "tribe-events-start-time"),
+    'venue': ("li", "tribe-venue"),
+    'street_address': ("span", "tribe-street-address"),
+    'postal_code': ("span", "tribe-postal-code"),
+    'locality': ("span", "tribe-locality"),
+    'categories': ("span", "tribe-events-event-categories"),
+    'image': ("img", "wp-post-image"),
+}
+
+# Only elements with these classes (and their content) are put in the tree, the rest of the page is skipped.
+# A regex, because while parsing the class attribute is still one string of space separated classes.
+STRAINER = SoupStrainer(class_=re.compile(
+    r"(^|\s)(" + "|".join(re.escape(css_class) for _, css_class in SELECTORS.values()) + r")(\s|$)"
+))
+
+
+def find_elements(page_html: str) -> dict:
+    """
+    Parse only the tribe event-meta and featured image elements of an event page.
+
+    :param page_html: HTML of the event page
+    :return: Per selector in `SELECTORS`, the first matching element or None
+    """
+    soup = BeautifulSoup(page_html, PARSER, parse_only=STRAINER)
+    return {key: soup.find(tag, css_class) for key, (tag, css_class) in SELECTORS.items()}
+
+
+def parse_event_page(page_html: str) -> dict:
+    """
+    Extract the event details from an event page.
+
+    :param page_html: HTML of the event page
+    :return: Event details, with the same keys as filled in by `main.get_event_info`
+    """
+    elements = find_elements(page_html)
+
+    details = {}
+    times = elements['start_time'].text.strip().split(' - ')
+    details['start_date'] = elements['start_date']['title']
+    details['end_date'] = elements['start_time']['title']
+    details['start_time'] = times[0]
+    details['end_time'] = times[1]
+
+    details['venue'] = elements['venue'].text.strip() if elements['venue'] is not None else ''
+
+    if elements['street_address'] is not None:
+        address, postal_code, locality = (
+            elements[key].text.strip() if elements[key] is not None else ''
+            for key in ('street_address', 'postal_code', 'locality')
+        )
+        details['address'] = f'{address}, {postal_code} {locality}'
+    else:
+        details['address'] = ''
+
+    if elements['categories'] is not None:
+        details['categories'] = [cat.text for cat in elements['categories'].find_all('a')]
+    else:
+        details['categories'] = []
+
+    details['image_url'] = elements['image']['src'] if elements['image'] is not None else None
+
+    return details
@@ -1,7 +1,10 @@
+import json
 import os
+import threading
 import time
+from contextlib import contextmanager
+from datetime import date
 
-import requests
 from seleniumrequests import Firefox
 from selenium.webdriver.common.keys import Keys
 from selenium.common import TimeoutException, NoSuchElementException
@@ -12,11 +15,60 @@ from selenium.webdriver.remote.webelement import WebElement
 import pyotp
 
 from adapter_base import AdapterBase, login_required
-from utils import runtime_data_folder
+import http_client
+from state_store import StateStore
+from utils import parse_datetime, runtime_data_folder
 
 graph_api_version = "v16.0"
 page_id = "204304653318353"
 
+# Saved cookies and page profile of the browser session
+session_file = runtime_data_folder / "facebook_session.json"
+# Cookies that are present when logged in
+login_cookies = ('c_user', 'xs')
+# Cookie with the id of the active (page) profile
+profile_cookie = 'i_user'
+# Whether Facebook shows the page as logged in (profile menu) or asks to log in, null while still loading
+login_state_script = """
+if (document.querySelector('svg[aria-label="Je profiel"]')) return 'logged_in';
+if (document.querySelector('button[name="login"], input[name="email"]') || location.pathname.startsWith('/login'))
+    return 'logged_out';
+return null;
+"""
+
+# Fields of the create/edit event form, found by their (Dutch) labels
+form_field_xpaths = {
+    'file': '//input[@type="file"]',
+    'name': '//*[contains(text(), "Evenementnaam")]/following-sibling::input',
+    'start_date': '//*[contains(text(), "Begindatum")]/following-sibling::div/input',
+    'start_time': '//*[contains(text(), "Starttijd")]/following-sibling::div/input',
+    'end_toggle': '//*[contains(text(), "Einddatum en -tijd")]',
+    'end_date': '//*[contains(text(), "Einddatum")]/following-sibling::div/input',
+    'end_time': '//*[contains(text(), "Eindtijd")]/following-sibling::div/input',
+    'event_type': '//*[contains(text(), "Is dit persoonlijk of virtueel?")]/following-sibling::*',
+    'location': '//*[contains(text(), "Locatie toevoegen")]/following-sibling::input',
+    'details': '//*[contains(text(), "Wat zijn de details?")]/following-sibling::div/textarea',
+}
+
+find_fields_script = """
+const fields = {};
+for (const [key, xpath] of Object.entries(arguments[0])) {
+    fields[key] = document.evaluate(xpath, document, null, XPathResult.FIRST_ORDERED_NODE_TYPE, null)
+        .singleNodeValue;
+}
+return fields;
+"""
+
+# Set input values the way React notices: with the native value setter, followed by an input event
+set_values_script = """
+for (const [element, value] of arguments[0]) {
+    const prototype = element instanceof HTMLTextAreaElement ? HTMLTextAreaElement.prototype : HTMLInputElement.prototype;
+    Object.getOwnPropertyDescriptor(prototype, 'value').set.call(element, value);
+    element.dispatchEvent(new Event('input', {bubbles: true}));
+    element.dispatchEvent(new Event('change', {bubbles: true}));
+}
+"""
+
 
 def get_long_lived_token(config: dict) -> str:
     """
@@ -26,17 +78,18 @@ def get_long_lived_token(config: dict) -> str:
     :param config: All the secrets
     :return: Long-lived page token
     """
-    api_response = requests.get(f"https://graph.facebook.com/{graph_api_version}/oauth/access_token",
-                                {"grant_type": "fb_exchange_token",
-                                 "client_id": config['FACEBOOK_APP_ID'],
-                                 "client_secret": config['FACEBOOK_APP_SECRET'],
-                                 "fb_exchange_token": config['FACEBOOK_GRAPH_API_TOKEN']}).json()
+    api_response = http_client.get(f"https://graph.facebook.com/{graph_api_version}/oauth/access_token",
+                                   {"grant_type": "fb_exchange_token",
+                                    "client_id": config['FACEBOOK_APP_ID'],
+                                    "client_secret": config['FACEBOOK_APP_SECRET'],
+                                    "fb_exchange_token": config['FACEBOOK_GRAPH_API_TOKEN']},
+                                   cache=False).json()
     long_lived_token = api_response['access_token']
-    api_response = requests.get(f"https://graph.facebook.com/{graph_api_version}/me?fields=id",
-                                {"access_token": config['FACEBOOK_GRAPH_API_TOKEN']}).json()
+    api_response = http_client.get(f"https://graph.facebook.com/{graph_api_version}/me?fields=id",
+                                   {"access_token": config['FACEBOOK_GRAPH_API_TOKEN']}, cache=False).json()
     app_scoped_user_id = api_response['id']
-    api_response = requests.get(f"https://graph.facebook.com/{graph_api_version}/{app_scoped_user_id}/accounts",
-                                {"access_token": long_lived_token}).json()
+    api_response = http_client.get(f"https://graph.facebook.com/{graph_api_version}/{app_scoped_user_id}/accounts",
+                                   {"access_token": long_lived_token}, cache=False).json()
     pages = api_response['data']
     page_token = ''
     for page in pages:
@@ -48,23 +101,177 @@ def get_long_lived_token(config: dict) -> str:
 
 
 class FacebookAdapter(AdapterBase):
-    def __init__(self, driver: Firefox, username: str, password: str, totp: str, graph_api_token: str):
-        super().__init__(driver, "Facebook")
+    def __init__(self, driver: Firefox, username: str, password: str, totp: str, graph_api_token: str,
+                 state: StateStore | None = None):
+        super().__init__(driver, "Facebook", state)
         self.__username = username
         self.__password = password
         self.__totp = totp
         self.__graph_api_token = graph_api_token
+        self.step_timings = {}  # Duration per step of the last create/update
+        self._profile_id = None
+
+    def _load_session(self) -> dict:
+        try:
+            with open(session_file, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {'cookies': [], 'profile_id': None}
+
+    def _save_session(self):
+        """
+        Save the cookies and the selected page profile, to restore them in a later session.
+        """
+        self._write_session({'cookies': self.driver.get_cookies(), 'profile_id': self._profile_id})
+
+    @staticmethod
+    def _write_session(session: dict):
+        # Write to a temporary file first, other browsers (see driver_pool) may be reading it
+        tmp_path = session_file.with_name(f"{session_file.name}.{threading.get_ident()}.tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(session, f)
+        os.replace(tmp_path, session_file)
+
+    @staticmethod
+    def _session_valid(cookies: list[dict]) -> bool:
+        """
+        Whether the cookies contain a login that has not expired, checked without loading anything.
+
+        :param cookies: Cookies as returned by Selenium
+        :return: If logged in
+        """
+        now = time.time()
+        cookies = {cookie['name']: cookie for cookie in cookies}
+        return all(name in cookies and cookies[name].get('expiry', now + 1) > now for name in login_cookies)
+
+    def _restore_session(self, session: dict) -> bool:
+        """
+        Make sure the browser has the login cookies, from its profile or from the saved session.
+
+        :param session: Saved session
+        :return: If the browser has a valid login
+        """
+        # Cookies can only be read and set on the domain, robots.txt is the cheapest document there
+        if not self.driver.current_url.startswith("https://www.facebook.com/"):
+            self.driver.get("https://www.facebook.com/robots.txt")
+        if self._session_valid(self.driver.get_cookies()):
+            return True
+        if not self._session_valid(session['cookies']):
+            return False
+        for cookie in session['cookies']:
+            self.driver.add_cookie(cookie)
+        return True
+
+    def _page_login_state(self, timeout: float = 10) -> str | None:
+        """
+        Whether the loaded page shows Facebook accepted the login cookies. They can be revoked by Facebook while still
+        valid locally. No page is loaded for this, it checks the page that is needed anyway.
+
+        :param timeout: Seconds to wait for the page to show either
+        :return: 'logged_in' (profile menu), 'logged_out' (login form), or None if still unknown, e.g. a slow load or
+                 a consent or checkpoint page
+        """
+        try:
+            return WebDriverWait(self.driver, timeout).until(lambda driver: driver.execute_script(login_state_script))
+        except TimeoutException:
+            return None
+
+    def _check_session(self, url: str):
+        """
+        After loading a page that needs the login: if Facebook did not accept the restored session, log in with the
+        password and load the page again. When it is unknown, the session is kept, and the page flow continues.
+
+        :param url: The loaded page
+        """
+        if self._page_login_state() != 'logged_out':
+            return
+        print("Facebook: Saved login session was not accepted, logging in again")
+        self._clear_session()
+        self.logged_in = False
+        self.login()
+        self.driver.get(url)
+
+    def _clear_session(self):
+        """
+        Forget the login cookies, in the browser and in the saved session, so the password login is used.
+        """
+        self.driver.delete_all_cookies()
+        session = self._load_session()
+        session['cookies'] = []
+        self._write_session(session)
+
+    def _profile_active(self) -> bool:
+        cookie = self.driver.get_cookie(profile_cookie)
+        return self._profile_id is not None and cookie is not None and cookie['value'] == self._profile_id
+
+    def _switch_profile(self):
+        # Do profile switch, this goes faster on a simple page like this for some reason.
+        if self.driver.current_url != "https://www.facebook.com/events/create/":
+            self.driver.get("https://www.facebook.com/events/create/")
+
+        # Click profile picture
+        profile_svg = self.driver.find_element(By.XPATH, '//*[name()="svg" and @aria-label="Je profiel"]')
+        profile_svg.click()
+        # Click BSS profile
+        profile_switch = self.driver.find_element(By.XPATH, '//div[@aria-label="Je profiel"]//span[text()="DSDA Blue Suede Shoes"]')
+        profile_switch.click()
+
+        WebDriverWait(self.driver, 10).until(
+            expected_conditions.url_to_be("https://www.facebook.com/events/create/")
+        )
+        try:
+            # The switch is done when the page profile cookie is set
+            cookie = WebDriverWait(self.driver, 5).until(lambda driver: driver.get_cookie(profile_cookie))
+            self._profile_id = cookie['value']
+        except TimeoutException:
+            print("Facebook: Could not determine the active profile, it will be switched again next time")
+            self._profile_id = None
+
+    def login(self, interactive: bool = True):
+        """
+        Log in, with the saved session if Facebook still accepts it, otherwise with the password and TOTP code.
 
-    def login(self):
+        :param interactive: Ask to log in manually when the automatic login gets stuck. When False, the login fails
+                            instead, for use from a background thread.
+        """
         if self.logged_in:
             return
+
+        session = self._load_session()
+        self._profile_id = session['profile_id']
+        if self._restore_session(session):
+            # Whether Facebook accepts the session is checked on the first page loaded for the profile switch, or
+            # else for creating or editing an event (see `_check_session`)
+            accepted = True
+            if not self._profile_active():
+                self.driver.get("https://www.facebook.com/events/create/")
+                accepted = self._page_login_state() != 'logged_out'
+            if accepted:
+                print("Facebook: Restored login session")
+                if not self._profile_active():
+                    self._switch_profile()
+                self._save_session()
+                self.logged_in = True
+                return
+            print("Facebook: Saved login session was not accepted, logging in again")
+            self._clear_session()
+
         self.driver.get("https://www.facebook.com/")
         try:
             login_button = self.driver.find_element(By.XPATH, '//button[@name="login"]')
         except NoSuchElementException:
             print("No login button found, assuming already logged in")
-            self.logged_in = True
-            return
+            login_button = None
+
+        if login_button is not None:
+            self._log_in_with_password(login_button, interactive)
+
+        if not self._profile_active():
+            self._switch_profile()
+        self._save_session()
+        self.logged_in = True
+
+    def _log_in_with_password(self, login_button: WebElement, interactive: bool = True):
         essential_cookies_button = self.driver.find_element(By.XPATH, '//div[@aria-label="Decline optional cookies"]')
         email_field = self.driver.find_element(By.ID, "email")
         password_field = self.driver.find_element(By.ID, "pass")
@@ -101,137 +308,177 @@ class FacebookAdapter(AdapterBase):
 
             WebDriverWait(self.driver, 15).until(expected_conditions.url_to_be("https://www.facebook.com/"))
         except TimeoutException:
+            if not interactive:
+                raise
             print("Timeout for automatic continuation")
             input("Press enter when logged in manually to continue")
 
-        # Do profile switch, this goes faster on a simple page like this for some reason.
-        self.driver.get("https://www.facebook.com/events/create/")
+    def get_events(self):
+        """
+        List events present on the Facebook page.
+        The list is kept for the session, until this adapter creates or edits an event.
 
-        # Click profile picture
-        profile_svg = self.driver.find_element(By.XPATH, '//*[name()="svg" and @aria-label="Je profiel"]')
-        profile_svg.click()
-        # Click BSS profile
-        profile_switch = self.driver.find_element(By.XPATH, '//div[@aria-label="Je profiel"]//span[text()="DSDA Blue Suede Shoes"]')
-        profile_switch.click()
+        :return: List of events, with id, name, start_time, end_time and description
+        """
+        if self._events_cache is not None:
+            return self._events_cache
+
+        return_events = []
+        url = f"https://graph.facebook.com/{graph_api_version}/{page_id}/events"
+        params = {"access_token": self.__graph_api_token, "fields": "id,name,start_time,end_time,description",
+                  "limit": 100}
+        while url:
+            api_response = http_client.get(url, params, cache=False)
+            # Todo: get long lived token
+            # https://developers.facebook.com/docs/facebook-login/guides/access-tokens/get-long-lived
+            if api_response.status_code == 400:
+                raise Exception(f"Facebook Graph API error: {api_response.json()['error']['message']}")
+            response = api_response.json()
+            return_events.extend(response['data'])
+            # The next URL already contains all parameters
+            url = response.get('paging', {}).get('next')
+            params = None
+
+        self._events_cache = return_events
+        return return_events
 
-        time.sleep(0.5)
-        WebDriverWait(self.driver, 10).until(
-            expected_conditions.url_to_be("https://www.facebook.com/events/create/")
-        )
+    def _platform_event_date(self, platform_event: dict) -> date | None:
+        if 'start_time' not in platform_event:
+            return None
+        return parse_datetime(platform_event['start_time']).date()
 
-        self.logged_in = True
+    def _event_from_id(self, platform_id: str) -> dict | None:
+        return {'id': platform_id}
 
-    def get_events(self):
+    def _published_id(self, existing_event: dict | None, result) -> str | None:
+        if existing_event is not None:
+            return existing_event['id']
+        # https://www.facebook.com/events/<id>/
+        long_url = result[0]
+        return long_url.rstrip('/').split('/')[-1]
+
+    @contextmanager
+    def _step(self, name: str):
         """
-        List events present on the Facebook page
+        Time a step of filling in or submitting the event form, see `step_timings`.
 
-        :return: List of events
+        :param name: Step name
         """
-        api_response = requests.get(f"https://graph.facebook.com/{graph_api_version}/{page_id}/events",
-                                    {"access_token": self.__graph_api_token})
-        # Todo: get long lived token
-        # https://developers.facebook.com/docs/facebook-login/guides/access-tokens/get-long-lived
-        if api_response.status_code == 400:
-            raise Exception(f"Facebook Graph API error: {api_response.json()['error']['message']}")
-        return_events = api_response.json()['data']
-        return return_events
+        start = time.perf_counter()
+        yield
+        self.step_timings[name] = time.perf_counter() - start
+
+    def _print_step_timings(self):
+        steps = ", ".join(f"{name} {duration:.2f} s" for name, duration in self.step_timings.items())
+        print(f"Facebook: Took {sum(self.step_timings.values()):.2f} s ({steps})")
+
+    def _find_form_fields(self) -> dict[str, WebElement | None]:
+        """
+        Find all form fields in one pass over the page.
+
+        :return: Per key of `form_field_xpaths`, the element or None if not (yet) present
+        """
+        return self.driver.execute_script(find_fields_script, form_field_xpaths)
 
     def _fil_event_info(self, event_info: dict):
-        # Setting image
-        filename = runtime_data_folder / event_info['image_name']
-        file = self.driver.find_element(By.XPATH, '//input[@type="file"]')
-        file.send_keys(str(filename))
-
-        self.driver.implicitly_wait(0)
-        end_date_input_xpath = '//*[contains(text(), "Einddatum")]/following-sibling::div/input'
-        end_field_test = self.driver.find_elements(By.XPATH, end_date_input_xpath)
-        if len(end_field_test) == 0:
-            # Open end date and time
-            self.driver.find_element(By.XPATH, '//*[contains(text(), "Einddatum en -tijd")]').click()
-        self.driver.implicitly_wait(5)
-
-        event_name_field = self.driver.find_element(By.XPATH, '//*[contains(text(), "Evenementnaam")]/following-sibling::input')
-        event_name_field.clear()
-        event_name_field.send_keys(event_info['name'])
-
-        # Date and time
-        event_start_date_field = self.driver.find_element(By.XPATH, '//*[contains(text(), "Begindatum")]/following-sibling::div/input')
-        event_start_date_field.send_keys([Keys.BACK_SPACE] * 20 + [Keys.DELETE] * 20)
-        event_start_date_field.send_keys(event_info['start'].strftime("%d-%m-%Y"))
-
-        event_start_time_field = self.driver.find_element(By.XPATH, '//*[contains(text(), "Starttijd")]/following-sibling::div/input')
-        event_start_time_field.click()
-        event_start_time_field.send_keys([Keys.BACK_SPACE] * 20 + [Keys.DELETE] * 20)
-        event_start_time_field.send_keys(event_info['start'].strftime("%H:%M"))
-
-        event_end_date_field = self.driver.find_element(By.XPATH, end_date_input_xpath)
-        event_end_date_field.click()
-        event_end_date_field.send_keys([Keys.BACK_SPACE] * 20 + [Keys.DELETE] * 20)
-        event_end_date_field.send_keys(event_info['end'].strftime("%d-%m-%Y"))
-
-        event_end_time_field = self.driver.find_element(By.XPATH, '//*[contains(text(), "Eindtijd")]/following-sibling::div/input')
-        event_end_time_field.click()
-        event_end_time_field.send_keys([Keys.BACK_SPACE] * 20 + [Keys.DELETE] * 20)
-        event_end_time_field.send_keys(event_info['end'].strftime("%H:%M"))
+        with self._step("form ready"):
+            fields = WebDriverWait(self.driver, 10).until(
+                lambda driver: (found := self._find_form_fields())['name'] is not None and found
+            )
+
+        with self._step("image"):
+            if event_info['image_path'] is not None:
+                fields['file'].send_keys(str(event_info['image_path']))
+
+        if fields['end_date'] is None:
+            with self._step("open end"):
+                # Open end date and time
+                fields['end_toggle'].click()
+                fields = WebDriverWait(self.driver, 5).until(
+                    lambda driver: (found := self._find_form_fields())['end_date'] is not None and found
+                )
+
+        # Date and time, select the current value and type over it in one go
+        with self._step("date and time"):
+            for key, value in (('start_date', event_info['start'].strftime("%d-%m-%Y")),
+                               ('start_time', event_info['start'].strftime("%H:%M")),
+                               ('end_date', event_info['end'].strftime("%d-%m-%Y")),
+                               ('end_time', event_info['end'].strftime("%H:%M"))):
+                fields[key].send_keys(Keys.CONTROL, "a", Keys.NULL, value)
 
         # Click this is a personal event, not online
-        self.driver.find_element(By.XPATH, '//*[contains(text(), "Is dit persoonlijk of virtueel?")]/following-sibling::*').click()
-        self.driver.find_element(By.XPATH, '//div[@role="option"][1]').click()  # First option
-
-        # Location
-        location_field = self.driver.find_element(By.XPATH, '//*[contains(text(), "Locatie toevoegen")]/following-sibling::input')
-        location_field.clear()
-        location_field.send_keys(f"{event_info['venue']}, {event_info['address']}")
-
-        event_name_field.click()  # Make other fields visible again
-        # Event details (description)
-        details_field = self.driver.find_element(By.XPATH, '//*[contains(text(), "Wat zijn de details?")]/following-sibling::div/textarea')
-        details_field.click()
-        details_field.clear()
+        with self._step("event type"):
+            fields['event_type'].click()
+            WebDriverWait(self.driver, 5).until(
+                expected_conditions.element_to_be_clickable((By.XPATH, '//div[@role="option"][1]'))
+            ).click()  # First option
+
+        # Text fields, set at once
         event_details = event_info['content-unicode']
         # Safeguard against empty details, an event cannot be posted when the details are empty.
         if len(event_details) == 0:
             event_details = "Details to be announced."
-        details_field.send_keys(event_details)
+        with self._step("text"):
+            # The event type menu can replace the elements and hide the other fields, clicking the name shows them
+            self._find_form_fields()['name'].click()
+            fields = WebDriverWait(self.driver, 5).until(
+                lambda driver: (found := self._find_form_fields())['location'] is not None
+                and found['details'] is not None and found
+            )
+            self.driver.execute_script(set_values_script, [
+                [fields['name'], event_info['name']],
+                [fields['location'], f"{event_info['venue']}, {event_info['address']}"],
+                [fields['details'], event_details],
+            ])
 
     @login_required
     def update_event(self, event_info: dict, existing_event: dict):
         edit_url = f"https://www.facebook.com/events/edit/{existing_event['id']}"
-        self.driver.get(edit_url)
-        time.sleep(0.5)
+        self._events_cache = None
+        self.step_timings = {}
+        with self._step("load"):
+            self.driver.get(edit_url)
+            self._check_session(edit_url)
 
         self._fil_event_info(event_info)
 
         # Hit update
-        self.driver.find_element(By.XPATH, '//div[@aria-label="Opslaan"]').click()
+        with self._step("submit"):
+            self.driver.find_element(By.XPATH, '//div[@aria-label="Opslaan"]').click()
 
-        WebDriverWait(self.driver, 10).until(
-            expected_conditions.url_contains(f"https://www.facebook.com/events/{existing_event['id']}")
-        )
+            WebDriverWait(self.driver, 10).until(
+                expected_conditions.url_contains(f"https://www.facebook.com/events/{existing_event['id']}")
+            )
 
         long_url, short_url = self.get_event_urls()
         print(f"Facebook: Edited event at {long_url}")
         print(f"          Short URL is {short_url}")
+        self._print_step_timings()
         return long_url, short_url
 
     @login_required
     def create_event(self, event_info: dict):
-        self.driver.get("https://www.facebook.com/events/create/")
-        time.sleep(0.5)
+        self._events_cache = None
+        self.step_timings = {}
+        with self._step("load"):
+            self.driver.get("https://www.facebook.com/events/create/")
+            self._check_session("https://www.facebook.com/events/create/")
 
         self._fil_event_info(event_info)
 
         # Hit create event
-        self.driver.find_element(By.XPATH, '//div[@aria-label="Evenement maken"]').click()
+        with self._step("submit"):
+            self.driver.find_element(By.XPATH, '//div[@aria-label="Evenement maken"]').click()
 
-        WebDriverWait(self.driver, 20).until(
-            expected_conditions.url_changes("https://www.facebook.com/events/create/")
-        )
-        time.sleep(1)
+            # Wait for the page of the new event
+            WebDriverWait(self.driver, 20).until(
+                expected_conditions.url_matches(r"^https://www\.facebook\.com/events/\d+")
+            )
 
         long_url, short_url = self.get_event_urls()
         print(f"Facebook: Created new event at {long_url}")
         print(f"          Short URL is {short_url}")
+        self._print_step_timings()
         return long_url, short_url
 
     @login_required
@@ -0,0 +1,98 @@
+import hashlib
+import json
+import os
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
+from utils import runtime_data_folder
+
+cache_folder = runtime_data_folder / "http_cache"
+
+# One session for all plain HTTP traffic, so connections to the website and the Graph API are kept alive and reused.
+session = requests.Session()
+_adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16)
+session.mount("https://", _adapter)
+session.mount("http://", _adapter)
+
+_cache_lock = threading.Lock()
+
+
+def _cache_key(url: str, params: dict | None) -> str:
+    request_id = url if not params else f"{url}?{json.dumps(params, sort_keys=True)}"
+    return hashlib.sha256(request_id.encode()).hexdigest()
+
+
+def _load_cached(key: str) -> tuple[dict, bytes] | None:
+    try:
+        with open(cache_folder / f"{key}.json", "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        with open(cache_folder / f"{key}.body", "rb") as f:
+            body = f.read()
+    except (FileNotFoundError, ValueError):
+        return None
+    return meta, body
+
+
+def _store_cached(key: str, response: requests.Response):
+    meta = {
+        'url': response.url,
+        'encoding': response.encoding,
+        'headers': dict(response.headers),
+    }
+    with _cache_lock:
+        cache_folder.mkdir(parents=True, exist_ok=True)
+        # Write to temporary files first, so a concurrent reader never sees half a response
+        for suffix, content in ((".body", response.content), (".json", json.dumps(meta).encode("utf-8"))):
+            tmp_path = cache_folder / f"{key}{suffix}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(content)
+            os.replace(tmp_path, cache_folder / f"{key}{suffix}")
+
+
+def _response_from_cache(meta: dict, body: bytes) -> requests.Response:
+    response = requests.Response()
+    response.status_code = 200
+    response._content = body
+    response.headers = CaseInsensitiveDict(meta['headers'])
+    response.url = meta['url']
+    response.encoding = meta['encoding']
+    response.from_cache = True
+    return response
+
+
+def get(url: str, params: dict | None = None, cache: bool = True, **kwargs) -> requests.Response:
+    """
+    GET a URL through the shared session.
+    With `cache`, the response is stored locally and revalidated with its ETag/Last-Modified on the next request,
+    so an unchanged resource costs a 304 instead of a full download.
+
+    :param url: URL to get
+    :param params: Query parameters
+    :param cache: Whether to use the local response cache. Disable for responses that should not be stored, or streams.
+    :param kwargs: Passed on to `requests.Session.get`
+    :return: Response, with status 200 when served from the cache
+    """
+    if not cache or kwargs.get('stream'):
+        return session.get(url, params=params, **kwargs)
+
+    key = _cache_key(url, params)
+    cached = _load_cached(key)
+    headers = dict(kwargs.pop('headers', None) or {})
+    if cached is not None:
+        cached_headers = CaseInsensitiveDict(cached[0]['headers'])
+        if 'ETag' in cached_headers:
+            headers['If-None-Match'] = cached_headers['ETag']
+        if 'Last-Modified' in cached_headers:
+            headers['If-Modified-Since'] = cached_headers['Last-Modified']
+
+    response = session.get(url, params=params, headers=headers, **kwargs)
+    if response.status_code == 304 and cached is not None:
+        return _response_from_cache(*cached)
+
+    response.from_cache = False
+    if response.status_code == 200 and ('ETag' in response.headers or 'Last-Modified' in response.headers):
+        _store_cached(key, response)
+    return response
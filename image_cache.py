@@ -0,0 +1,131 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from pathlib import Path
+
+import http_client
+from utils import file_sha256
+
+
+class ImageCache:
+    """
+    Content-addressed on-disk cache of downloaded images.
+    Files are named after a hash of the URL and its ETag/Last-Modified, so a changed image gets a new file and an
+    unchanged one keeps the same path across runs. The least recently used files are evicted when the cache exceeds
+    its size limit.
+    """
+
+    def __init__(self, folder: Path, max_bytes: int = 200 * 1024 * 1024, max_age: float = 24 * 60 * 60):
+        """
+        :param folder: Folder to keep the images and the index in
+        :param max_bytes: Maximum total size of the cached images
+        :param max_age: Seconds a cached image is used without asking the server whether it changed
+        """
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self._index_path = folder / "index.json"
+        self._lock = threading.Lock()
+        self._index = None
+
+    def _load_index(self) -> dict:
+        if self._index is None:
+            try:
+                with open(self._index_path, "r", encoding="utf-8") as f:
+                    self._index = json.load(f)
+            except (FileNotFoundError, ValueError):
+                self._index = {}
+        return self._index
+
+    def _save_index(self):
+        tmp_path = self._index_path.with_suffix(".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self._index, f)
+        os.replace(tmp_path, self._index_path)
+
+    def _evict(self, keep: str):
+        """
+        Remove least recently used images until the cache fits its size limit.
+
+        :param keep: URL of the image that must stay
+        """
+        index = self._load_index()
+        total = sum(entry['size'] for entry in index.values())
+        for url, entry in sorted(index.items(), key=lambda item: item[1]['last_used']):
+            if total <= self.max_bytes:
+                break
+            if url == keep:
+                continue
+            (self.folder / entry['file']).unlink(missing_ok=True)
+            total -= entry['size']
+            del index[url]
+
+    def get(self, url: str) -> Path | None:
+        """
+        Get the local path of an image, downloading it only if it is not cached or has changed.
+
+        :param url: Image URL
+        :return: Path to the image, None if it could not be downloaded
+        """
+        self.folder.mkdir(parents=True, exist_ok=True)
+        with self._lock:
+            entry = self._load_index().get(url)
+            if entry is not None and not (self.folder / entry['file']).exists():
+                entry = None
+            if entry is not None and time.time() - entry['checked'] < self.max_age:
+                entry['last_used'] = time.time()
+                self._save_index()
+                return self.folder / entry['file']
+
+        headers = {}
+        if entry is not None:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+
+        r = http_client.get(url, stream=True, headers=headers)
+        if r.status_code == 304 and entry is not None:
+            with self._lock:
+                entry['checked'] = entry['last_used'] = time.time()
+                self._save_index()
+            return self.folder / entry['file']
+        if r.status_code != 200:
+            return None
+
+        etag = r.headers.get('ETag')
+        last_modified = r.headers.get('Last-Modified')
+        extension = url.split("?")[0].split(".")[-1].lower()
+        tmp_path = self.folder / f"{threading.get_ident()}.download"
+        r.raw.decode_content = True
+        with open(tmp_path, 'wb') as f:
+            shutil.copyfileobj(r.raw, f)
+
+        if etag or last_modified:
+            key = hashlib.sha256(f"{url}\n{etag}\n{last_modified}".encode()).hexdigest()
+        else:
+            # Without validators, address the image by its content
+            key = file_sha256(tmp_path)
+        file_name = f"{key}.{extension}"
+        os.replace(tmp_path, self.folder / file_name)
+
+        with self._lock:
+            index = self._load_index()
+            old_entry = index.get(url)
+            if old_entry is not None and old_entry['file'] != file_name:
+                (self.folder / old_entry['file']).unlink(missing_ok=True)
+            now = time.time()
+            index[url] = {
+                'file': file_name,
+                'size': (self.folder / file_name).stat().st_size,
+                'etag': etag,
+                'last_modified': last_modified,
+                'checked': now,
+                'last_used': now,
+            }
+            self._evict(keep=url)
+            self._save_index()
+        return self.folder / file_name
@@ -3,9 +3,11 @@ import warnings
 import importlib
 import html
 import os
+from concurrent.futures import ThreadPoolExecutor
 from json import loads
+from pathlib import Path
+from typing import Iterable, Iterator
 
-import requests
 from datetime import datetime
 
 from seleniumrequests import Firefox
@@ -14,69 +16,146 @@ from selenium.webdriver.firefox.options import Options
 from bs4 import BeautifulSoup
 
 from calendar_adapter import CalendarAdapter
+from driver_pool import DriverPool
 import facebook_adapter as FA
+from event_page import parse_event_page
+import http_client
+from image_cache import ImageCache
+from warm_start import WarmStart
+from prefetch import EventPrefetcher
+from planner import WRITE_ACTIONS, apply_plan, make_plan, print_plan
+from state_store import StateStore
 from text_transforms import trim_list, get_list, render_unicode, render_whatsapp
 from utils import DEFAULT_TZ, ask_confirmation, runtime_data_folder
 
-headers = {
-    "Cache-Control": "no-cache",
-    "Pragma": "no-cache"
-}
+tribe_events_url = "https://dsda.nl/wp-json/tribe/events/v1/events"
+
+image_cache = ImageCache(runtime_data_folder / "image_cache")
+
+# Send Calendar writes in batch requests, or else as parallel single requests
+calendar_batched = os.getenv("CALENDAR_BATCHED", "1") == "1"
+
+# Number of browsers used to publish many events on Facebook at the same time, 1 to use a single browser
+browser_pool_size = int(os.getenv("BROWSER_POOL_SIZE", "1"))
+
 
+def iter_events(per_page: int = 50) -> Iterator[dict]:
+    """
+    Read the website events feed page by page, yielding events as each page arrives.
+    Only the fields that are used are requested.
+
+    :param per_page: Number of events requested per page, at most 100
+    :return: Events
+    """
+    page = 1
+    total_pages = 1
+    while page <= total_pages:
+        r = http_client.get("https://dsda.nl/wp-json/wp/v2/tribe_events",
+                            {"per_page": per_page, "page": page, "_fields": "title,content,link,slug"})
+        r.raise_for_status()
+        total_pages = int(r.headers.get("X-WP-TotalPages", 1))
+        for event in r.json():
+            yield {'name': html.unescape(event['title']['rendered']), 'content': event['content']['rendered'],
+                   'link': event['link'], 'slug': event['slug']}
+        page += 1
+
+
+def _event_from_tribe(tribe_event: dict) -> dict:
+    """
+    Convert an event of The Events Calendar REST API to the event dict that `get_event_info` would produce from the
+    event page.
 
-def get_events():
+    :param tribe_event: Event as returned by the API
+    :return: Event info, without rendered content and image download
+    """
+    start = datetime.strptime(tribe_event['start_date'], "%Y-%m-%d %H:%M:%S")
+    end = datetime.strptime(tribe_event['end_date'], "%Y-%m-%d %H:%M:%S")
+    event = {
+        'name': html.unescape(tribe_event['title']),
+        'content': tribe_event['description'],
+        'link': tribe_event['url'],
+        'slug': tribe_event['slug'],
+        'start_date': start.strftime("%Y-%m-%d"),
+        'end_date': end.strftime("%Y-%m-%d"),
+        'start_time': start.strftime("%H:%M"),
+        'end_time': end.strftime("%H:%M"),
+        'start': DEFAULT_TZ.localize(start),
+        'end': DEFAULT_TZ.localize(end),
+        'categories': [html.unescape(category['name']) for category in tribe_event.get('categories', [])],
+        'image_url': tribe_event['image']['url'] if tribe_event.get('image') else None,
+    }
+
+    # The venue is an empty list when not set
+    venue = tribe_event.get('venue') or {}
+    event['venue'] = html.unescape(venue.get('venue', ''))
+    if venue.get('address'):
+        event['address'] = f"{html.unescape(venue['address'])}, {venue.get('zip', '')} {venue.get('city', '')}"
+    else:
+        event['address'] = ''
+
+    return event
+
+
+def iter_tribe_events(per_page: int = 50) -> Iterator[dict]:
+    """
+    Read all upcoming events with their details from The Events Calendar REST API, page by page.
+    This gives the same information as scraping each event page, in a couple of requests.
+
+    :param per_page: Number of events requested per page
+    :return: Events, with details filled in
+    """
+    url = tribe_events_url
+    params = {"per_page": per_page}
+    while url:
+        r = http_client.get(url, params)
+        r.raise_for_status()
+        response = r.json()
+        for tribe_event in response.get('events', []):
+            yield _event_from_tribe(tribe_event)
+        # The next URL already contains all parameters
+        url = response.get('next_rest_url')
+        params = None
+
+
+def get_events(structured: bool = True) -> list[dict]:
+    """
+    Get the events from the website.
+
+    :param structured: Get the event details in bulk from The Events Calendar API. If that fails, or when disabled,
+                       only the basic info is listed and the details are scraped from the event pages when needed.
+    :return: Events
+    """
     print("Getting events from website")
-    events_raw = requests.get("https://dsda.nl/wp-json/wp/v2/tribe_events?per_page=25", headers=headers).json()
-    events = [{'name': html.unescape(event['title']['rendered']), 'content': event['content']['rendered'],
-               'link': event['link'], 'slug': event['slug']} for event in events_raw]
+    if structured:
+        try:
+            return list(iter_tribe_events())
+        except Exception as e:
+            print(f"Could not get events from The Events Calendar API, falling back to scraping: {e!r}")
+    return list(iter_events())
 
-    return events
 
+def _scrape_event_details(event: dict):
+    """
+    Fill in the event details by scraping the event page.
 
-def get_event_info(event: dict) -> dict:
-    event_page = requests.get(event['link'], headers=headers)
-    soup = BeautifulSoup(event_page.text, 'html.parser')
-
-    start_date = soup.find("abbr", "tribe-events-start-date")['title']
-    end_date = soup.find("div", "tribe-events-start-time")['title']
-    times = soup.find("div", "tribe-events-start-time").text.strip()
-    times = times.split(' - ')
-    event['start_date'] = start_date
-    event['end_date'] = end_date
-    event['start_time'] = times[0]
-    event['end_time'] = times[1]
+    :param event: Event with at least a link
+    """
+    event_page = http_client.get(event['link'])
+    event.update(parse_event_page(event_page.text))
     event['start'] = DEFAULT_TZ.localize(
         datetime.strptime(f"{event['start_date']} {event['start_time']}", "%Y-%m-%d %H:%M"))
     event['end'] = DEFAULT_TZ.localize(datetime.strptime(f"{event['end_date']} {event['end_time']}", "%Y-%m-%d %H:%M"))
 
-    try:
-        event['venue'] = soup.find("li", "tribe-venue").text.strip()
-    except AttributeError:
-        event['venue'] = ''
 
-    if soup.find("span", "tribe-street-address") is not None:
-        try:
-            address = soup.find("span", "tribe-street-address").text.strip()
-        except AttributeError:
-            address = ''
-        try:
-            postal_code = soup.find("span", "tribe-postal-code").text.strip()
-        except AttributeError:
-            postal_code = ''
-        try:
-            locality = soup.find("span", "tribe-locality").text.strip()
-        except AttributeError:
-            locality = ''
-        event['address'] = f'{address}, {postal_code} {locality}'
-    else:
-        event['address'] = ''
+def get_event_info(event: dict) -> dict:
+    """
+    Complete the event info: details (scraped from the event page if not known yet), rendered content and image.
 
-    try:
-        categories_wrapper = soup.find("span", "tribe-events-event-categories")
-        categories = [cat.text for cat in categories_wrapper.find_all('a')]
-    except AttributeError:
-        categories = []
-    event['categories'] = categories
+    :param event: Event as returned by `get_events`
+    :return: The same event, with all info
+    """
+    if 'start' not in event:
+        _scrape_event_details(event)
 
     content_soup = BeautifulSoup(event['content'], 'html.parser')
     content_text_list = trim_list(get_list(content_soup.children))
@@ -89,38 +168,90 @@ def get_event_info(event: dict) -> dict:
         event['content-unicode'] = render_unicode(content_text_list)
         event['content-whatsapp'] = render_whatsapp(content_text_list) + f"\n\nAll details:\n{event['link']}"
 
-    image_tag = soup.find("img", "wp-post-image")
-    if image_tag is not None:
-        image_url = image_tag['src']
-        r = requests.get(image_url, stream=True, headers=headers)
-        if r.status_code == 200:
-            extension = image_url.split(".")[-1].lower()
-            event['image_name'] = f'event-image.{extension}'
-            with open(runtime_data_folder / event['image_name'], 'wb') as f:
-                import shutil
-                r.raw.decode_content = True
-                shutil.copyfileobj(r.raw, f)
-        else:
+    if event['image_url'] is not None:
+        event['image_path'] = image_cache.get(event['image_url'])
+        if event['image_path'] is None:
             warnings.warn("Could not download event image.")
     else:
-        event['image_name'] = None
+        event['image_path'] = None
         warnings.warn("Event does not have an image.")
 
     return event
 
 
-def create_driver():
-    ff_path = 'geckodriver.exe'  # Same Directory as Python Program
+def get_events_info(events: Iterable[dict], max_workers: int = 8) -> list[tuple[dict, Exception | None]]:
+    """
+    Get the detailed information of many events concurrently, see `get_event_info`.
+
+    :param events: Events as returned by `get_events`. Can also be `iter_events()`, then fetching starts while later
+                   pages of the feed are still loading.
+    :param max_workers: Maximum number of events fetched at the same time
+    :return: Per event, in the original order, the event and the exception that occurred (None if successful)
+    """
+    def fetch(event: dict) -> tuple[dict, Exception | None]:
+        try:
+            return get_event_info(event), None
+        except Exception as e:
+            return event, e
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(fetch, events))
+
+    for event, error in results:
+        if error is not None:
+            print(f"Error while getting event information of {event['name']}: {error!r}")
+    return results
+
+
+# Firefox preferences for the performance browser mode: skip everything that is not needed to fill in forms
+performance_preferences = {
+    'permissions.default.image': 2,  # No images
+    'media.autoplay.default': 5,  # No audio or video
+    'media.autoplay.blocking_policy': 2,
+    'browser.display.use_document_fonts': 0,  # No web fonts
+    'gfx.downloadable_fonts.enabled': False,
+    'network.cookie.cookieBehavior': 1,  # No third-party cookies
+    'privacy.trackingprotection.enabled': True,  # No trackers
+    'privacy.trackingprotection.socialtracking.enabled': True,
+    'network.prefetch-next': False,
+    'network.dns.disablePrefetch': True,
+}
+
+
+def create_driver(performance: bool | None = None, profile_dir: Path | None = None) -> Firefox:
+    """
+    Start Firefox for the Selenium adapters.
+    The geckodriver and Firefox binary can be set with the GECKODRIVER_PATH and FIREFOX_BINARY environment variables.
+    By default, geckodriver.exe next to this program and the standard Firefox install are used on Windows, and
+    whatever Selenium finds elsewhere.
+
+    :param performance: Headless, without images, fonts, media and trackers, and not waiting for a page to fully load.
+                        Defaults to the PERFORMANCE_BROWSER environment variable being 1.
+    :param profile_dir: Firefox profile to use, defaults to the one in the runtime data
+    :return: Browser
+    """
+    if performance is None:
+        performance = os.getenv("PERFORMANCE_BROWSER") == "1"
+
+    ff_path = os.getenv("GECKODRIVER_PATH", 'geckodriver.exe' if os.name == 'nt' else None)
     service = Service(executable_path=ff_path)
 
     options = Options()
-    options.binary_location = r'C:\Program Files\Mozilla Firefox\firefox.exe'
-    ff_profile_dir = runtime_data_folder / 'firefox-profile'
-    ff_profile_dir.mkdir(exist_ok=True)
+    binary = os.getenv("FIREFOX_BINARY", r'C:\Program Files\Mozilla Firefox\firefox.exe' if os.name == 'nt' else None)
+    if binary is not None:
+        options.binary_location = binary
+    ff_profile_dir = profile_dir or runtime_data_folder / 'firefox-profile'
+    ff_profile_dir.mkdir(parents=True, exist_ok=True)
 
     options.add_argument("-profile")
     options.add_argument(str(ff_profile_dir))
 
+    if performance:
+        options.add_argument("-headless")
+        options.page_load_strategy = 'eager'
+        for name, value in performance_preferences.items():
+            options.set_preference(name, value)
+
     driver = Firefox(service=service, options=options)
     driver.implicitly_wait(5)
     return driver
@@ -157,9 +288,26 @@ def get_config() -> dict:
     return conf
 
 
-def create_fb_adapter(config: dict, driver: Firefox) -> FA.FacebookAdapter:
+def create_fb_adapter(config: dict, driver: Firefox, state: StateStore | None = None) -> FA.FacebookAdapter:
     return FA.FacebookAdapter(driver, config["FACEBOOK_ID"], config["FACEBOOK_PASSWORD"],
-                              config["FACEBOOK_TOTP"], config["FACEBOOK_GRAPH_API_TOKEN"])
+                              config["FACEBOOK_TOTP"], config["FACEBOOK_GRAPH_API_TOKEN"], state)
+
+
+def clear_events_caches(*adapters: FA.FacebookAdapter | None):
+    """
+    Make adapters list Facebook again, after it was changed by other adapters (the pool, or the browser adapter when
+    the listing adapter made the plan). Otherwise the same events would be matched and created again.
+
+    :param adapters: Adapters, None for ones not created yet
+    """
+    for adapter in adapters:
+        if adapter is not None:
+            adapter.clear_events_cache()
+
+
+def create_fb_pool(config: dict, state: StateStore | None = None) -> DriverPool:
+    return DriverPool(browser_pool_size, lambda profile_dir: create_driver(profile_dir=profile_dir),
+                      lambda pool_driver: create_fb_adapter(config, pool_driver, state))
 
 
 # Press the green button in the gutter to run the script.
@@ -170,10 +318,16 @@ if __name__ == '__main__':
 
     # get_long_lived_token(config)  # Use when you need such a token. Obviously.
 
-    calendar = CalendarAdapter()
-    driver = None
+    state = StateStore()
+    calendar = CalendarAdapter(batched=calendar_batched, state=state)
+    # Browser, Facebook login and Calendar service start while the menu is shown
+    warm = WarmStart(create_driver, lambda warm_driver: create_fb_adapter(config, warm_driver, state), calendar)
+    # Event details are fetched while the user reads the menu
+    prefetcher = EventPrefetcher(get_event_info)
     unilife_adapter = None
     facebook_adapter = None
+    # Facebook adapter without browser, for the Graph API listing of plans
+    facebook_lister = None
 
     quit_loop = False
     bulk_mode = False
@@ -183,28 +337,42 @@ if __name__ == '__main__':
         # Interfacing with user
         # Select event or quit
         print("\nSelect event to process:")
-        print("  Press q to quit, r to refresh, b to turn on bulk mode. (dev) R to reload Facebook adapter.")
+        print("  Press q to quit, r to refresh, b to turn on bulk mode, a to process all events (bulk mode only), "
+              "p to plan and apply all events. (dev) R to reload Facebook adapter.")
         for i, event in enumerate(events):
             print(f"  {i + 1}: {event['name']}")
             pass
+        prefetcher.prefetch(events)
 
         choice = -1
+        process_all = False
+        plan_all = False
         while choice <= 0 or choice > len(events):
             _input = input("Pick: ")
             if _input == 'b':
                 bulk_mode = not bulk_mode
                 print(f"Turned bulk mode {'on' if bulk_mode else 'off'}.")
                 continue
+            if _input == 'a':
+                if not bulk_mode:
+                    print("Processing all events is only available in bulk mode.")
+                    continue
+                process_all = True
+                break
+            if _input == 'p':
+                plan_all = True
+                break
             if _input == 'q':
                 quit_loop = True
                 break
             if _input == 'r':
+                calendar.refresh()
                 continue_loop = True
                 break
             if _input == 'R':
                 importlib.reload(FA)
-                was_logged_in = facebook_adapter.logged_in
-                facebook_adapter = create_fb_adapter(config, driver)
+                was_logged_in = facebook_adapter is not None and facebook_adapter.logged_in
+                facebook_adapter = create_fb_adapter(config, warm.driver, state)
                 facebook_adapter.logged_in = was_logged_in
                 continue
             choice = int(_input)
@@ -216,42 +384,82 @@ if __name__ == '__main__':
         if continue_loop:
             continue
 
-        # Actual work with the event
-        event = events[choice - 1]
-        try:
-            event = get_event_info(event)
-        except Exception as e:
-            print("Error while getting event information")
-            logging.exception(e)
+        if plan_all:
+            print(f"Getting information of all {len(events)} events")
+            plan_events = [event for event, error in get_events_info(events) if error is None]
+            if facebook_lister is None:
+                # Planning does not wait for the browser and login
+                facebook_lister = create_fb_adapter(config, None, state)
+            plan = make_plan(plan_events, calendar, facebook_lister)
+            print_plan(plan)
+            if any(row['action'] in WRITE_ACTIONS for row in plan) and ask_confirmation("Apply this plan?"):
+                # Many Facebook changes are spread over several browsers
+                facebook_writes = sum(row['platform'] == "Facebook" and row['action'] in WRITE_ACTIONS
+                                      for row in plan)
+                if facebook_writes > 1 and browser_pool_size > 1:
+                    with create_fb_pool(config, state) as pool:
+                        apply_plan(plan, calendar, facebook_lister, facebook_pool=pool)
+                else:
+                    # The browser is only needed when Facebook has to change
+                    if facebook_writes and facebook_adapter is None:
+                        facebook_adapter = warm.facebook_adapter
+                    apply_plan(plan, calendar, facebook_adapter)
+                if facebook_writes:
+                    clear_events_caches(facebook_adapter, facebook_lister)
+                calendar.print_stats()
             continue
 
-        print(f"Processing {event['name']} on {event['start_date']}")
+        # Actual work with the event(s)
+        if process_all:
+            print(f"Getting information of all {len(events)} events")
+            selected_events = [event for event, error in get_events_info(events) if error is None]
+            # In bulk, only the calendars are published to, all events at once
+            if calendar.batched:
+                calendar.do_events(selected_events)
+            else:
+                calendar.do_events_parallel(selected_events)
+            calendar.print_stats()
+            if browser_pool_size > 1 and ask_confirmation(
+                    f"Do you want to put all events on Facebook, using {browser_pool_size} browsers?"):
+                with create_fb_pool(config, state) as pool:
+                    results = pool.publish(selected_events)
+                clear_events_caches(facebook_adapter, facebook_lister)
+                print(f"Facebook: {sum(result is not None for _, result in results)} of {len(results)} events done")
+        else:
+            try:
+                selected_events = [prefetcher.get(events[choice - 1])]
+            except Exception as e:
+                print("Error while getting event information")
+                logging.exception(e)
+                continue
+
+        for event in selected_events:
+            print(f"Processing {event['name']} on {event['start_date']}")
 
-        if bulk_mode or ask_confirmation("Do you want to put this in the Google Calendar?"):
-            g_events = calendar.do_event(event)
+            # When processing all events, the calendars are already done, all at once
+            if not process_all and (bulk_mode or ask_confirmation("Do you want to put this in the Google Calendar?")):
+                g_events = calendar.do_event(event)
 
-        # Unilife is, unfortunately, not used anymore by the TU Delft.
-        # if bulk_mode or ask_confirmation("Do you want to put this event on Unilife?"):
-        #     if driver is None:
-        #         driver = create_driver()
-        #     if unilife_adapter is None:
-        #         unilife_adapter = UnilifeAdapter(driver, config["UNILIFE_ID"], config["UNILIFE_PASSWORD"])
-        #     unilife_success = unilife_adapter.do_event(event)
+            # Unilife is, unfortunately, not used anymore by the TU Delft.
+            # if bulk_mode or ask_confirmation("Do you want to put this event on Unilife?"):
+            #     if unilife_adapter is None:
+            #         unilife_adapter = UnilifeAdapter(warm.driver, config["UNILIFE_ID"], config["UNILIFE_PASSWORD"],
+            #                                          state)
+            #     unilife_success = unilife_adapter.do_event(event)
 
-        # Move based on what you want to bulk
-        if bulk_mode:
-            continue
+            # Move based on what you want to bulk
+            if bulk_mode:
+                continue
 
-        if bulk_mode or ask_confirmation("Do you want to put this event on Facebook?"):
-            if driver is None:
-                driver = create_driver()
-            if facebook_adapter is None:
-                facebook_adapter = create_fb_adapter(config, driver)
-            facebook_adapter.do_event(event)
+            if bulk_mode or ask_confirmation("Do you want to put this event on Facebook?"):
+                if facebook_adapter is None:
+                    facebook_adapter = warm.facebook_adapter
+                facebook_adapter.do_event(event)
 
-        if bulk_mode or ask_confirmation("Do you want a WhatsApp share message?"):
-            print()  # New line
-            print(event['content-whatsapp'])
+            if bulk_mode or ask_confirmation("Do you want a WhatsApp share message?"):
+                print()  # New line
+                print(event['content-whatsapp'])
 
-    if driver is not None:
-        driver.quit()
+    prefetcher.close()
+    warm.close()
+    state.close()
@@ -0,0 +1,204 @@
+import logging
+from datetime import datetime, timezone
+
+from calendar_adapter import CalendarAdapter
+from calendar_index import parse_event_time
+from driver_pool import DriverPool
+from facebook_adapter import FacebookAdapter
+from unilife_adapter import UnilifeAdapter
+from utils import parse_datetime
+
+# Actions that change a platform
+WRITE_ACTIONS = ('create', 'update')
+
+
+def _row(platform: str, target: str, action: str, event: dict | None, existing: dict | None = None,
+         changes: list[str] | None = None) -> dict:
+    return {'platform': platform, 'target': target, 'action': action, 'event': event, 'existing': existing,
+            'changes': changes or []}
+
+
+def plan_calendar(events: list[dict], calendar: CalendarAdapter) -> list[dict]:
+    """
+    Plan the Google Calendar actions for the website events.
+
+    :param events: Website events, with details (see `main.get_event_info`)
+    :param calendar: Calendar adapter
+    :return: Plan rows
+    """
+    plan = []
+    matched_ids = set()
+    categories = set()
+    for event in events:
+        for category in calendar.event_categories(event):
+            categories.add(category)
+            g_event = calendar.find_event(event, category)
+            if g_event is None:
+                plan.append(_row("Calendar", category, 'create', event))
+                continue
+            matched_ids.add((category, g_event['id']))
+            changes = calendar.changed_fields(calendar.g_event_from_event(event, category), g_event)
+            plan.append(_row("Calendar", category, 'update' if changes else 'unchanged', event, g_event,
+                             list(changes)))
+
+    # Upcoming calendar events that are not on the website (anymore)
+    now = datetime.now(timezone.utc)
+    for category in sorted(categories):
+        for g_event in calendar.index(category).events.values():
+            if (category, g_event['id']) not in matched_ids and parse_event_time(g_event['start']) > now:
+                plan.append(_row("Calendar", category, 'missing', None, g_event))
+    return plan
+
+
+def plan_facebook(events: list[dict], facebook: FacebookAdapter) -> list[dict]:
+    """
+    Plan the Facebook actions for the website events. Only the Graph API listing is used, no browser.
+
+    :param events: Website events, with details
+    :param facebook: Facebook adapter
+    :return: Plan rows
+    """
+    plan = []
+    platform_events = facebook.get_events()
+    matched_ids = set()
+    for event in events:
+        existing = facebook._select_event(platform_events, event)
+        if existing is None:
+            plan.append(_row("Facebook", "", 'create', event))
+            continue
+        matched_ids.add(existing['id'])
+        if facebook.is_published(event):
+            plan.append(_row("Facebook", "", 'unchanged', event, existing))
+            continue
+        changes = []
+        if existing.get('name') != event['name']:
+            changes.append('name')
+        if existing.get('description', '').strip() != event['content-unicode'].strip():
+            changes.append('description')
+        for field, time_field in (('start', 'start_time'), ('end', 'end_time')):
+            if existing.get(time_field) is None or parse_datetime(existing[time_field]) != event[field]:
+                changes.append(field)
+        plan.append(_row("Facebook", "", 'update' if changes else 'unchanged', event, existing, changes))
+
+    now = datetime.now(timezone.utc)
+    for platform_event in platform_events:
+        if platform_event['id'] not in matched_ids and parse_datetime(platform_event['start_time']) > now:
+            plan.append(_row("Facebook", "", 'missing', None, platform_event))
+    return plan
+
+
+def plan_unilife(events: list[dict], unilife: UnilifeAdapter) -> list[dict]:
+    """
+    Plan the Unilife actions for the website events.
+
+    :param events: Website events, with details
+    :param unilife: Unilife adapter
+    :return: Plan rows
+    """
+    plan = []
+    platform_events = unilife.get_events()
+    matched_links = set()
+    for event in events:
+        existing = unilife._select_event(platform_events, event)
+        if existing is None:
+            plan.append(_row("Unilife", "", 'create', event))
+            continue
+        matched_links.add(existing['link'])
+        if unilife.is_published(event):
+            plan.append(_row("Unilife", "", 'unchanged', event, existing))
+            continue
+        changes = []
+        if existing.get('name') != event['name']:
+            changes.append('name')
+        if existing.get('location') != event['venue']:
+            changes.append('location')
+        if unilife._platform_event_date(existing) != event['start'].date():
+            changes.append('start')
+        plan.append(_row("Unilife", "", 'update' if changes else 'unchanged', event, existing, changes))
+
+    today = datetime.now().date()
+    for platform_event in platform_events:
+        start_date = unilife._platform_event_date(platform_event)
+        if platform_event['link'] not in matched_links and start_date is not None and start_date >= today:
+            plan.append(_row("Unilife", "", 'missing', None, platform_event))
+    return plan
+
+
+def make_plan(events: list[dict], calendar: CalendarAdapter | None = None, facebook: FacebookAdapter | None = None,
+              unilife: UnilifeAdapter | None = None) -> list[dict]:
+    """
+    Compare the website events with every given platform, before anything is written.
+
+    :param events: Website events, with details (see `main.get_event_info`)
+    :param calendar: Calendar adapter, None to leave out
+    :param facebook: Facebook adapter, None to leave out
+    :param unilife: Unilife adapter, None to leave out
+    :return: Plan rows, with the platform, target (calendar category), action (create, update, unchanged, or
+             missing for platform events that are not on the website), event, existing platform event and changed fields
+    """
+    plan = []
+    if calendar is not None:
+        plan += plan_calendar(events, calendar)
+    if facebook is not None:
+        plan += plan_facebook(events, facebook)
+    if unilife is not None:
+        plan += plan_unilife(events, unilife)
+    return plan
+
+
+def print_plan(plan: list[dict]):
+    print(f"\n{'action':10} {'platform':10} {'target':16} event")
+    for row in plan:
+        name = row['event']['name'] if row['event'] is not None else \
+            row['existing'].get('summary', row['existing'].get('name'))
+        changes = f" ({', '.join(row['changes'])})" if row['changes'] else ""
+        print(f"{row['action']:10} {row['platform']:10} {row['target']:16} {name}{changes}")
+
+    counts = {action: sum(row['action'] == action for row in plan)
+              for action in ('create', 'update', 'unchanged', 'missing')}
+    print(", ".join(f"{count} {action}" for action, count in counts.items()))
+
+
+def apply_plan(plan: list[dict], calendar: CalendarAdapter | None = None, facebook: FacebookAdapter | None = None,
+               unilife: UnilifeAdapter | None = None, facebook_pool: DriverPool | None = None) -> list[dict]:
+    """
+    Execute the create and update actions of a plan. Unchanged and missing events are left alone.
+
+    :param plan: Plan rows from `make_plan`
+    :param calendar: Calendar adapter
+    :param facebook: Facebook adapter
+    :param unilife: Unilife adapter
+    :param facebook_pool: Browsers to spread the Facebook actions over, instead of using `facebook`
+    :return: The executed rows, with the result of the action (None if it failed)
+    """
+    adapters = {"Facebook": facebook, "Unilife": unilife}
+    executed = []
+    if facebook_pool is not None:
+        facebook_rows = [row for row in plan if row['platform'] == "Facebook" and row['action'] in WRITE_ACTIONS]
+        results = facebook_pool.map(
+            lambda adapter, row: adapter._publish(row['event'], row['existing'] if row['action'] == 'update' else None),
+            facebook_rows)
+        executed += [dict(row, result=result) for row, result in zip(facebook_rows, results)]
+        plan = [row for row in plan if row['platform'] != "Facebook"]
+        # The pool browsers changed Facebook, the listing of the main adapter is outdated
+        if facebook is not None and facebook_rows:
+            facebook.clear_events_cache()
+
+    for row in plan:
+        if row['action'] not in WRITE_ACTIONS:
+            continue
+        event, existing = row['event'], row['existing']
+        try:
+            if row['platform'] == "Calendar":
+                if row['action'] == 'create':
+                    result = calendar.create_event(event, row['target'])
+                else:
+                    result = calendar.update_event(event, existing, row['target'])
+            else:
+                # Also remembers the publication in the state store
+                result = adapters[row['platform']]._publish(event, existing if row['action'] == 'update' else None)
+        except Exception:
+            logging.exception(f"{row['platform']}: Something went wrong processing {event['name']}")
+            result = None
+        executed.append(dict(row, result=result))
+    return executed
@@ -0,0 +1,80 @@
+import copy
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+
+
+class EventPrefetcher:
+    """
+    Fetches the details of listed events in the background, nearest dates first, while the user is choosing one.
+    Entries stay valid as long as the event is listed the same way, so a refresh of the list keeps them.
+    """
+
+    def __init__(self, fetch: Callable[[dict], dict], max_entries: int = 12, max_workers: int = 2):
+        """
+        :param fetch: Gets the details of a listed event, e.g. `main.get_event_info`. Gets a copy of the event.
+        :param max_entries: Maximum number of events prefetched and kept
+        :param max_workers: Maximum number of events fetched at the same time
+        """
+        self._fetch = fetch
+        self.max_entries = max_entries
+        # Slug -> (event as listed, future of the event with details), least recently used first
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="prefetch")
+
+    @staticmethod
+    def _nearest_first(event: dict) -> tuple[bool, float]:
+        # Events from the wp/v2 fallback have no start yet, they keep their listing order after the others
+        start = event.get('start')
+        return start is None, start.timestamp() if start is not None else 0.0
+
+    def prefetch(self, events: list[dict]):
+        """
+        Start fetching the details of the nearest events, and forget entries of events that changed or are no longer
+        listed.
+
+        :param events: Events as listed by `main.get_events`
+        """
+        listed = {event['slug']: event for event in events}
+        with self._lock:
+            for slug, (listed_event, future) in list(self._entries.items()):
+                if listed.get(slug) != listed_event:
+                    future.cancel()
+                    del self._entries[slug]
+
+            for event in sorted(events, key=self._nearest_first)[:self.max_entries]:
+                if event['slug'] not in self._entries:
+                    self._entries[event['slug']] = (copy.deepcopy(event),
+                                                    self._executor.submit(self._fetch, copy.deepcopy(event)))
+
+            while len(self._entries) > self.max_entries:
+                _, (_, future) = self._entries.popitem(last=False)
+                future.cancel()
+
+    def get(self, event: dict) -> dict:
+        """
+        Get the details of an event, from the prefetched entry if there is one (waiting for it if still running).
+
+        :param event: Event as listed
+        :return: Event with details, see `main.get_event_info`
+        """
+        with self._lock:
+            entry = self._entries.get(event['slug'])
+            if entry is not None:
+                self._entries.move_to_end(event['slug'])
+
+        if entry is not None and entry[0] == event:
+            try:
+                # A copy, the entry stays usable when the publishing changes the event
+                return copy.deepcopy(entry[1].result())
+            except Exception:
+                # Try again below, the error is raised from there if it persists
+                with self._lock:
+                    if self._entries.get(event['slug']) is entry:
+                        del self._entries[event['slug']]
+        return self._fetch(event)
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,85 @@
+import hashlib
+import json
+import sqlite3
+import threading
+from datetime import datetime
+from pathlib import Path
+
+from utils import runtime_data_folder
+
+
+def payload_hash(payload: dict) -> str:
+    """
+    Hash of a published payload, to see whether it changed since the last publish.
+
+    :param payload: What is published on a platform
+    :return: Hex digest
+    """
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class StateStore:
+    """
+    Remembers between runs where each website event (by slug) is published: the id on every platform, and a hash
+    of what was published there last.
+    """
+
+    def __init__(self, path: Path = runtime_data_folder / "state.sqlite3"):
+        """
+        :param path: SQLite database file
+        """
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Shared between threads, access is serialized with the lock
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.row_factory = sqlite3.Row
+        self._lock = threading.Lock()
+        with self._lock, self._connection:
+            self._connection.execute("""
+                CREATE TABLE IF NOT EXISTS publications (
+                    slug TEXT NOT NULL,
+                    platform TEXT NOT NULL,
+                    target TEXT NOT NULL DEFAULT '',
+                    platform_id TEXT,
+                    payload_hash TEXT,
+                    updated_at TEXT NOT NULL,
+                    PRIMARY KEY (slug, platform, target)
+                )
+            """)
+
+    def get(self, slug: str, platform: str, target: str = "") -> dict | None:
+        """
+        Get what is known about the publication of an event.
+
+        :param slug: Website event slug
+        :param platform: Platform name, e.g. "calendar"
+        :param target: Part of the platform, e.g. the calendar category
+        :return: platform_id, payload_hash and updated_at, None if never published
+        """
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT platform_id, payload_hash, updated_at FROM publications "
+                "WHERE slug = ? AND platform = ? AND target = ?", (slug, platform, target)).fetchone()
+        return dict(row) if row is not None else None
+
+    def record(self, slug: str, platform: str, target: str, platform_id: str | None, published_hash: str | None):
+        """
+        Remember that an event was published.
+
+        :param slug: Website event slug
+        :param platform: Platform name
+        :param target: Part of the platform
+        :param platform_id: Id (or link) of the event on the platform, None if unknown
+        :param published_hash: Hash of the published payload, see `payload_hash`
+        """
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT INTO publications (slug, platform, target, platform_id, payload_hash, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (slug, platform, target) DO UPDATE SET "
+                "platform_id = COALESCE(excluded.platform_id, platform_id), payload_hash = excluded.payload_hash, "
+                "updated_at = excluded.updated_at",
+                (slug, platform, target, platform_id, published_hash, datetime.now().isoformat()))
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
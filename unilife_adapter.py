@@ -1,15 +1,149 @@
+import io
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
 import warnings
+from datetime import date, datetime
+from pathlib import Path
+from urllib.parse import quote_plus, urlencode, urljoin
 
 from seleniumrequests import Firefox
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions
 import base64
-from bs4 import BeautifulSoup
-from typing import BinaryIO
 
 from adapter_base import AdapterBase, login_required
-from utils import runtime_data_folder
+from state_store import StateStore
+from utils import file_sha256, runtime_data_folder
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None  # Images are sent as they are, with `legacy_crop_boxes`
+
+image_payload_folder = runtime_data_folder / "unilife_images"
+# Bigger images are downscaled before they are sent (needs Pillow)
+max_image_size = (1920, 1920)
+# Aspect ratio (width / height) of every image crop Unilife shows, from the crops used for a 1920x1006 banner
+crop_ratios = {
+    'img_discover_big': 1158 / 1006,
+    'img_discover_small': 1835 / 1006,
+    'img_card': 1635 / 1006,
+    'img_details': 1424 / 1006,
+}
+# Crop boxes used when the image size is not known, made for a 1920x1006 banner
+legacy_crop_boxes = {
+    "eventimage[img_discover_big]": '{"width": 1158, "height": 1006, "left": 181, "top": 0}',
+    "eventimage[img_discover_small]": '{"width": 1835, "height": 1006, "left": 42, "top": 0}',
+    "eventimage[img_card]": '{"width": 1635, "height": 1006, "left": 79, "top": 0}',
+    "eventimage[img_details]": '{"width": 1424, "height": 1006, "left": 92, "top": 0}',
+}
+
+# Form (CSRF) token, as a hidden input or meta tag
+_token_input = re.compile(r"<input\b[^>]*\bname=[\"']_token[\"'][^>]*>", re.IGNORECASE)
+_value_attribute = re.compile(r"\bvalue=[\"']([^\"']*)[\"']", re.IGNORECASE)
+_token_meta = re.compile(r"<meta\b[^>]*\bname=[\"']csrf-token[\"'][^>]*\bcontent=[\"']([^\"']*)[\"']",
+                         re.IGNORECASE)
+
+# Encoded image payload per (path, modification time, size), so retries do not even hash the image again
+_image_payloads = {}
+_image_payloads_lock = threading.Lock()
+
+
+def extract_form_token(page: str) -> str | None:
+    """
+    Find the form token in a page, without parsing all of it.
+
+    :param page: HTML
+    :return: Token, None if the page has none
+    """
+    token_input = _token_input.search(page)
+    if token_input is not None:
+        value = _value_attribute.search(token_input.group(0))
+        if value is not None:
+            return value.group(1)
+    token_meta = _token_meta.search(page)
+    return token_meta.group(1) if token_meta is not None else None
+
+
+def crop_boxes(width: int, height: int) -> dict[str, str]:
+    """
+    The largest crop of every Unilife image format that fits in the image, centered.
+
+    :param width: Image width
+    :param height: Image height
+    :return: Form fields with the crop boxes
+    """
+    boxes = {}
+    for name, ratio in crop_ratios.items():
+        crop_width, crop_height = (round(height * ratio), height) if width / height >= ratio else \
+            (width, round(width / ratio))
+        box = {"width": crop_width, "height": crop_height, "left": (width - crop_width) // 2,
+               "top": (height - crop_height) // 2}
+        boxes[f"eventimage[{name}]"] = json.dumps(box)
+    return boxes
+
+
+def _read_image(image_path: Path) -> tuple[io.BufferedIOBase, tuple[int, int] | None]:
+    """
+    Open an image to send, downscaled if it is too big.
+
+    :param image_path: Image file
+    :return: Image data and its size, None if unknown (without Pillow)
+    """
+    if Image is None:
+        return open(image_path, "rb"), None
+
+    with Image.open(image_path) as image:
+        if image.width <= max_image_size[0] and image.height <= max_image_size[1]:
+            return open(image_path, "rb"), image.size
+        image_format = image.format or "PNG"
+        image.thumbnail(max_image_size)
+        data = io.BytesIO()
+        image.save(data, format=image_format)
+        data.seek(0)
+        return data, image.size
+
+
+def image_payload(image_path: Path) -> Path:
+    """
+    Get the url-encoded image form fields of an image: the base64 encoded image and the crop boxes.
+    They are encoded once per image content, and kept in a file to stream in request bodies.
+
+    :param image_path: Image file
+    :return: File with the encoded form fields, without leading "&"
+    """
+    stat = image_path.stat()
+    key = (str(image_path), stat.st_mtime_ns, stat.st_size)
+    with _image_payloads_lock:
+        payload_path = _image_payloads.get(key)
+    if payload_path is not None and payload_path.exists():
+        return payload_path
+
+    content_hash = file_sha256(image_path)
+    # The same image gives another payload when it is downscaled differently
+    processing = f"max{max_image_size[0]}x{max_image_size[1]}" if Image is not None else "original"
+    payload_path = image_payload_folder / f"{content_hash}-{processing}.txt"
+    if not payload_path.exists():
+        image_payload_folder.mkdir(parents=True, exist_ok=True)
+        image, size = _read_image(image_path)
+        tmp_path = payload_path.with_name(f"{payload_path.name}.{threading.get_ident()}.tmp")
+        with image, open(tmp_path, "wb") as payload:
+            boxes = crop_boxes(*size) if size is not None else legacy_crop_boxes
+            payload.write(urlencode(boxes).encode() + b"&" + quote_plus("eventimage[img_source]").encode()
+                          + b"=")
+            # Chunks of a multiple of 3 bytes encode to base64 without padding in between
+            while chunk := image.read(3 * 64 * 1024):
+                payload.write(quote_plus(base64.b64encode(chunk)).encode())
+        os.replace(tmp_path, payload_path)
+
+    with _image_payloads_lock:
+        _image_payloads[key] = payload_path
+    return payload_path
 
 
 class UnilifeAdapter(AdapterBase):
@@ -17,10 +151,14 @@ class UnilifeAdapter(AdapterBase):
     login_url = "https://app.uni-life.nl/login"
     create_url = "https://app.uni-life.nl/event/create"
 
-    def __init__(self, driver: Firefox, username: str, password: str):
-        super().__init__(driver, "Unilife")
+    # URL of an event, also the start of its edit URLs
+    event_url_pattern = re.compile(r"^https://app\.uni-life\.nl/event/\d+")
+
+    def __init__(self, driver: Firefox, username: str, password: str, state: StateStore | None = None):
+        super().__init__(driver, "Unilife", state)
         self.__username = username
         self.__password = password
+        self._form_token_value = None
 
     def login(self):
         if self.logged_in:
@@ -35,53 +173,105 @@ class UnilifeAdapter(AdapterBase):
         WebDriverWait(self.driver, 10).until(
             expected_conditions.url_to_be(self.base_url)
         )
+        # A new session has a new form token
+        self._form_token_value = None
         self.logged_in = True
 
 
-    def _get_events_request(self):
+    def _get_events_request(self, page: int):
         return self.driver.request('GET', self.base_url,
-                            params={'direction': 'asc', 'search': '', 'filter': '', 'page': 0},
+                            params={'direction': 'asc', 'search': '', 'filter': '', 'page': page},
                             headers={"Accept": "application/json, text/plain, */*"})
 
-    @login_required
-    def get_events(self):
+    @staticmethod
+    def _is_last_page(response: dict) -> bool:
         """
-        List events present in our Unilife account
+        Whether the pagination metadata of a listing response says it is the last page, as Laravel paginators give
+        it at the top level or under `meta`.
 
-        :return: List of events
+        :param response: Listing response
+        :return: If it is the last page, False when there is no metadata
         """
-        if self.driver.current_url != self.base_url:
-            self.driver.get(self.base_url)
+        for pagination in (response, response.get('meta'), response.get('pagination')):
+            if isinstance(pagination, dict) and 'current_page' in pagination and 'last_page' in pagination:
+                return pagination['current_page'] >= pagination['last_page']
+        return False
 
-        r = self._get_events_request()
+    def _get_events_page(self, page: int) -> tuple[list[dict], bool]:
+        r = self._get_events_request(page)
         if r.status_code == 401:
             print("Unilife login expired, logging in and trying again")
             self.logged_in = False
             self.login()
-            r = self._get_events_request()
+            r = self._get_events_request(page)
+        r.raise_for_status()
+
+        response = r.json()
+        return [{
+            'name': event['content'][0]['value'],
+            'location': event['content'][3]['value'],
+            'start_date': event['content'][4]['value'],
+            'end_date': event['content'][5]['value'],
+            'link': event['metadata']['actions'][0]['url'],
+        } for event in response['body']], self._is_last_page(response)
+
+    @login_required
+    def get_events(self):
+        """
+        List events present in our Unilife account, page by page until an empty or the last page.
+        The list is kept for the session, until this adapter creates or edits an event.
+
+        :return: List of events
+        """
+        if self._events_cache is not None:
+            return self._events_cache
+
+        if self.driver.current_url != self.base_url:
+            self.driver.get(self.base_url)
 
-        unilife_events = r.json()['body']
         return_events = []
+        seen_links = set()
+        page = 0
+        while True:
+            page_events, last_page = self._get_events_page(page)
+            new_events = [event for event in page_events if event['link'] not in seen_links]
+            # Laravel treats page 0 as page 1, so page 1 repeating page 0 is expected. A later page with only known
+            # events means the page number is ignored, stop instead of requesting the same page forever.
+            if not page_events or (not new_events and page > 1):
+                break
+            for event in new_events:
+                seen_links.add(event['link'])
+                return_events.append(event)
+            if last_page:
+                break
+            page += 1
 
-        for event in unilife_events:
-            return_events.append({
-                'name': event['content'][0]['value'],
-                'location': event['content'][3]['value'],
-                'start_date': event['content'][4]['value'],
-                'end_date': event['content'][5]['value'],
-                'link': event['metadata']['actions'][0]['url'],
-            })
+        self._events_cache = return_events
         return return_events
 
+    def _platform_event_date(self, platform_event: dict) -> date | None:
+        try:
+            return datetime.strptime(platform_event['start_date'][:10], "%d-%m-%Y").date()
+        except (KeyError, TypeError, ValueError):
+            return None
+
+    def _event_from_id(self, platform_id: str) -> dict | None:
+        return {'link': platform_id}
+
+    def _published_id(self, existing_event: dict | None, result) -> str | None:
+        if existing_event is not None:
+            return existing_event['link']
+        # Link of the created event, True when it is not known
+        return result if isinstance(result, str) else None
+
     @staticmethod
-    def unilife_event_from_event(event: dict, token: str, image: BinaryIO | None) -> dict:
+    def unilife_event_from_event(event: dict, token: str) -> dict:
         """
-        Create a dictionary in Unilife format from event info.
+        Create a dictionary in Unilife format from event info. The image fields are added by `image_payload`.
 
         :param event: Source event info
         :param token: Form token
-        :param image: Image file
-        :return: Event info in Calendar format
+        :return: Event info in Unilife format
         """
 
         values = {
@@ -106,20 +296,6 @@ class UnilifeAdapter(AdapterBase):
             "endtime[minutes]": event['end'].minute,
             "visibility": "public"
         }
-
-        # If an image is supplied, include it and sizing information
-        if image:
-            encoded_string = base64.b64encode(image.read())
-            image.close()
-            update = {
-                'eventimage[img_source]': encoded_string,
-                "eventimage[img_discover_big]": '{"width": 1158, "height": 1006, "left": 181, "top": 0}',
-                "eventimage[img_discover_small]": '{"width": 1835, "height": 1006, "left": 42, "top": 0}',
-                "eventimage[img_card]": '{"width": 1635, "height": 1006, "left": 79, "top": 0}',
-                "eventimage[img_details]": '{"width": 1424, "height": 1006, "left": 92, "top": 0}',
-            }
-            values.update(update)
-
         return values
 
     def create_event(self, event: dict):
@@ -127,21 +303,45 @@ class UnilifeAdapter(AdapterBase):
         Create Unilife event based on the supplied event information.
 
         :param event: Source info
-        :return: If creation was successful
-        """
-        created_event = self.general_event_action(event, self.create_url, "POST")
-        if created_event:
-            print(f"Unilife: Created {event['name']} event")
-            # Get URL of just created event
-            platform_events = self.get_events()
-            existing_event = self._select_event_auto(platform_events, event)
-            if existing_event is not None:
-                self.driver.get(existing_event['link'])  # Show event to manually check.
-            else:
-                warnings.warn("Unilife: Something went wrong showing just created event")
-        else:
+        :return: Link of the created event, True if created but the link is unknown, False if creation failed
+        """
+        response = self.general_event_action(event, self.create_url, "POST")
+        if not self._succeeded(response):
             warnings.warn(f"Unilife: Something went wrong creating the {event['name']} event")
-        return created_event
+            return False
+
+        print(f"Unilife: Created {event['name']} event")
+        link = self._created_event_link(response)
+        if link is None:
+            # Not in the response, find it in the listing
+            existing_event = self._select_event_auto(self.get_events(), event)
+            link = existing_event['link'] if existing_event is not None else None
+        if link is None:
+            warnings.warn("Unilife: Something went wrong showing just created event")
+            return True
+        self.driver.get(link)  # Show event to manually check.
+        return link
+
+    def _created_event_link(self, response) -> str | None:
+        """
+        Find the link of a created event in the create response: the URL it redirected to, or a URL in its JSON.
+
+        :param response: Response of the create request, with redirects followed
+        :return: Event link, None if not found
+        """
+        candidates = [redirect.headers.get('Location', '') for redirect in response.history] + [response.url]
+        if 'json' in response.headers.get('Content-Type', ''):
+            try:
+                body = response.json()
+            except ValueError:
+                body = {}
+            if isinstance(body, dict):
+                candidates += [body[key] for key in ('url', 'redirect', 'link') if isinstance(body.get(key), str)]
+        for candidate in candidates:
+            match = self.event_url_pattern.match(urljoin(self.base_url, candidate))
+            if match:
+                return match.group(0)
+        return None
 
     def update_event(self, event: dict, unilife_event: dict, ):
         """
@@ -151,7 +351,7 @@ class UnilifeAdapter(AdapterBase):
         :param unilife_event: Existing Unilife event info
         :return: If update was successful
         """
-        updated_event = self.general_event_action(event, unilife_event['link'], "PUT")
+        updated_event = self._succeeded(self.general_event_action(event, unilife_event['link'], "PUT"))
         if updated_event:
             print(f"Unilife: Updated {event['name']} event")
             self.driver.get(unilife_event['link'])  # Show event to manually check.
@@ -159,27 +359,86 @@ class UnilifeAdapter(AdapterBase):
             warnings.warn(f"Unilife: Something went wrong updating the {event['name']} event")
         return updated_event
 
+    def _form_token(self, refresh: bool = False) -> str:
+        """
+        Get the form (CSRF) token of the session. It is the same for every form, so it is only looked up again when
+        the server rejects it.
+
+        :param refresh: Get a new token from the server, the known one was rejected
+        :return: Token
+        """
+        if self._form_token_value is None or refresh:
+            # The page the browser shows after logging in usually has the token already
+            token = None if refresh else extract_form_token(self.driver.page_source)
+            if token is None:
+                r = self.driver.request('GET', self.create_url)
+                if self._login_expired(r):
+                    # The token of the login page would be rejected again after logging in
+                    self._log_in_again()
+                    token = extract_form_token(self.driver.page_source)
+                    if token is None:
+                        r = self.driver.request('GET', self.create_url)
+                if token is None and not self._login_expired(r):
+                    token = extract_form_token(r.text)
+            if token is None:
+                raise Exception("Unilife: Could not find a form token")
+            self._form_token_value = token
+        return self._form_token_value
+
+    def _post_event(self, event: dict, url: str, method: str):
+        # Create form data, streamed from a file so the encoded image is not copied around in memory
+        values = self.unilife_event_from_event(event, self._form_token())
+        with tempfile.TemporaryFile() as body:
+            body.write(urlencode(values).encode())
+            if event['image_path']:
+                body.write(b"&")
+                with open(image_payload(Path(event['image_path'])), "rb") as image_fields:
+                    shutil.copyfileobj(image_fields, body)
+            length = body.tell()
+            body.seek(0)
+
+            return self.driver.request(method, url, data=body,
+                                       headers={"Content-Type": "application/x-www-form-urlencoded",
+                                                "Content-Length": str(length)})
+
+    def _login_expired(self, response) -> bool:
+        return response.status_code == 401 or response.url.startswith(self.login_url)
+
+    def _succeeded(self, response) -> bool:
+        """
+        Whether a write was accepted. A redirect to the login page also ends with status 200, but did not write.
+        """
+        return response.status_code == 200 and not self._login_expired(response)
+
+    def _log_in_again(self):
+        print("Unilife login expired, logging in and trying again")
+        self.logged_in = False
+        self.login()
+
     def general_event_action(self, event: dict, url: str, method: str):
         """
         Functional part of updating/creating a Unilife event.
+        In the common case this is a single request, the form token of the session is reused.
 
         :param event: Event source info
         :param url: URL to use for posting info to. Can result in create or update.
         :param method: For updates, the method property should be PUT, for new items, POST.
-        :return: If post was successful
+        :return: Response of the post, after redirects
         """
         if not self.logged_in:
             self.login()
+        self._events_cache = None
 
-        # Get a creation token. Not sure if and why this is necessary.
-        r = self.driver.request('GET', url)
-        soup = BeautifulSoup(r.text, 'html.parser')
-        token_input = soup.find("input", {'name': '_token'})
-        token = token_input.get('value')
-
-        # Create form data
-        values = self.unilife_event_from_event(event, token, open(runtime_data_folder / event['image_name'], "rb"))
-
-        # Post event
-        posted = self.driver.request(method, url, data=values)
-        return posted.status_code == 200
+        posted = self._post_event(event, url, method)
+        # Laravel answers 419 to an expired form token, also when the whole session expired (the token is checked
+        # first), and 401 or a redirect to the login page to an expired login. Getting a new token logs in again
+        # when needed.
+        if self._login_expired(posted):
+            self._log_in_again()
+            posted = self._post_event(event, url, method)
+        elif posted.status_code == 419:
+            print("Unilife: Form token expired, getting a new one and trying again")
+            self._form_token(refresh=True)
+            posted = self._post_event(event, url, method)
+        # Not tried again, see `_succeeded` for whether this one was accepted
+        return posted
@@ -1,3 +1,6 @@
+import hashlib
+import re
+from datetime import datetime
 from pathlib import Path
 
 import pytz
@@ -7,6 +10,35 @@ DEFAULT_TZ = pytz.timezone(DEFAULT_TZ_STR)
 project_dir = Path(__file__).parent
 runtime_data_folder = project_dir / "runtime_data"
 
+_utc_suffix = re.compile(r"Z$")
+_offset_without_colon = re.compile(r"([+-]\d{2})(\d{2})$")
+
+
+def file_sha256(path: Path) -> str:
+    """
+    SHA-256 of a file, read in chunks (hashlib.file_digest needs Python 3.11).
+
+    :param path: File
+    :return: Hex digest
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(1024 * 1024):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def parse_datetime(value: str) -> datetime:
+    """
+    Parse an ISO 8601 moment as the APIs give it, also with a "Z" or "+0100" offset, which
+    `datetime.fromisoformat` only reads from Python 3.11.
+
+    :param value: Date and time
+    :return: Datetime, timezone aware if `value` has an offset
+    """
+    value = _utc_suffix.sub("+00:00", value)
+    return datetime.fromisoformat(_offset_without_colon.sub(r"\1:\2", value))
+
 
 def ask_confirmation(query):
     result = True
@@ -0,0 +1,74 @@
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable
+
+from selenium.webdriver import Firefox
+
+from calendar_adapter import CalendarAdapter
+from facebook_adapter import FacebookAdapter
+
+
+class WarmStart:
+    """
+    Starts the slow resources in the background while the user is still choosing what to do: the browser, the
+    Facebook login and the Google Calendar service. Whatever is used first waits for its start to finish, if needed.
+    """
+
+    def __init__(self, create_driver: Callable[[], Firefox],
+                 create_facebook_adapter: Callable[[Firefox], FacebookAdapter], calendar: CalendarAdapter):
+        """
+        :param create_driver: Starts the browser, e.g. `main.create_driver`
+        :param create_facebook_adapter: Creates the Facebook adapter for the browser
+        :param calendar: Calendar adapter, its service is built in the background
+        """
+        self._create_facebook_adapter = create_facebook_adapter
+        self._closing = threading.Event()
+        self._executor = ThreadPoolExecutor(max_workers=3, thread_name_prefix="warm-start")
+        self._driver_future = self._executor.submit(create_driver)
+        self._calendar_future = self._executor.submit(lambda: calendar.service)
+        self._facebook_future = self._executor.submit(self._start_facebook)
+
+    def _start_facebook(self) -> FacebookAdapter:
+        adapter = self._create_facebook_adapter(self._driver_future.result())
+        if not self._closing.is_set():
+            try:
+                # Never prompts, the main thread is reading the menu choice
+                adapter.login(interactive=False)
+            except Exception as error:
+                # Not fatal, login_required tries again on the first publish, where logging in manually is possible
+                print(f"Facebook: Could not log in in the background, will try again when publishing: {error!r}")
+        return adapter
+
+    @staticmethod
+    def _wait(future: Future, what: str):
+        if not future.done():
+            print(f"Waiting for the {what} to be ready")
+        return future.result()
+
+    @property
+    def driver(self) -> Firefox:
+        return self._wait(self._driver_future, "browser")
+
+    @property
+    def facebook_adapter(self) -> FacebookAdapter:
+        return self._wait(self._facebook_future, "Facebook login")
+
+    def close(self):
+        """
+        Stop everything that was started, also when it is still starting.
+        """
+        self._closing.set()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        try:
+            # A browser that is still starting is waited for, it would be left running otherwise.
+            # Quitting it also ends a login that is in progress.
+            driver = self._driver_future.result()
+        except Exception:
+            driver = None
+        if driver is not None:
+            try:
+                driver.quit()
+            except Exception:
+                logging.exception("Could not close the browser")
+        self._executor.shutdown(wait=True)